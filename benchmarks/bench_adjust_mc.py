@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+""" bench_adjust_mc.py
+
+overhead of AdjustMC.get_multi on large batches of missed keys, with and
+without remembering the routing of hot keys.
+"""
+
+import zlib
+from timeit import timeit
+
+from douban.mc.wrapper import AdjustMC
+
+N = 200
+
+
+class Client(object):
+    " routes like a modula distribution, misses every key "
+    def __init__(self, servers):
+        self.servers = servers
+
+    def get_host_by_key(self, key):
+        return self.servers[(zlib.crc32(key) & 0xffffffff) % len(self.servers)]
+
+    def get_multi(self, keys):
+        return {}
+
+
+class LegacyAdjustMC(AdjustMC):
+    def moved(self, key):
+        return self._oldmc.get_host_by_key(key) != self._newmc.get_host_by_key(key)
+
+    def get_multi(self, keys):
+        r = self._newmc.get_multi(keys)
+        rs = self._oldmc.get_multi([k for k in keys if k not in r and self.moved(k)])
+        r.update(rs)
+        return r
+
+
+def main():
+    old = Client(['10.0.0.%d:11211' % i for i in range(8)])
+    new = Client(['10.0.0.%d:11211' % i for i in range(12)])
+    for batch in (100, 500, 2000):
+        keys = ['user:%d' % i for i in xrange(batch)]
+        for cls in (LegacyAdjustMC, AdjustMC):
+            mc = cls(old, new)
+            cost = timeit(lambda: mc.get_multi(keys), number=N) / N
+            print '%4d keys %-15s %8.1f us/get_multi' % (
+                batch, cls.__name__, cost * 1e6)
+
+
+if __name__ == '__main__':
+    main()
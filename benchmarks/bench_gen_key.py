@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+""" bench_gen_key.py
+
+per-hit overhead of key generation, before and after precompiling the key
+pattern at decoration time.
+"""
+
+import inspect
+from timeit import timeit
+
+from douban.utils import format
+from douban.mc.debug import LocalMemcache
+from douban.mc.decorator import key_factory, cache
+
+N = 200000
+
+
+def legacy_gen_key_factory(key_pattern, arg_names, defaults):
+    args = dict(zip(arg_names[-len(defaults):], defaults)) if defaults else {}
+    def gen_key(*a, **kw):
+        aa = args.copy()
+        aa.update(zip(arg_names, a))
+        aa.update(kw)
+        key = format(key_pattern, *[aa[n] for n in arg_names], **aa)
+        return key and key.replace(' ','_'), aa
+    return gen_key
+
+
+def get_user_feed(user_id, category='all', start=0):
+    pass
+
+
+def main():
+    key_pattern = 'feed:{user_id}:{category}:{start}'
+    arg_names, _, _, defaults = inspect.getargspec(get_user_feed)
+    legacy = legacy_gen_key_factory(key_pattern, arg_names, defaults)
+    compiled = key_factory(key_pattern, arg_names, defaults)
+    assert legacy(42, start=20)[0] == compiled(42, start=20)
+
+    mc = LocalMemcache()
+    cached = cache(key_pattern, mc)(get_user_feed)
+    mc.set(compiled(42, start=20), [1, 2, 3])
+
+    for name, func in [('legacy gen_key', lambda: legacy(42, start=20)),
+                       ('compiled gen_key', lambda: compiled(42, start=20)),
+                       ('cache() hit', lambda: cached(42, start=20))]:
+        cost = timeit(func, number=N)
+        print '%-20s %.3f us/call' % (name, cost / N * 1e6)
+
+
+if __name__ == '__main__':
+    main()
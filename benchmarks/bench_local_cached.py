@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+""" bench_local_cached.py
+
+hit ratio and cost of LocalCached on zipfian traces, compared with the
+former clear-everything-at-capacity policy.
+"""
+
+import time
+import random
+from bisect import bisect
+
+from douban.mc.wrapper import LocalCached
+
+KEYS = 100000
+REQUESTS = 300000
+SIZE = 10000
+
+
+class Backend(object):
+    def __init__(self):
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return key
+
+
+class LegacyLocalCached(object):
+    def __init__(self, mc_client, size=10000):
+        self.dataset = {}
+        self.mc = mc_client
+        self.size = size
+
+    def _cache(self, key, value):
+        if len(self.dataset) >= self.size:
+            self.dataset.clear()
+        self.dataset[key] = value
+
+    def get(self, key):
+        if key in self.dataset:
+            return self.dataset[key]
+        r = self.mc.get(key)
+        if r is not None:
+            self._cache(key, r)
+        return r
+
+
+def zipf_trace(s, n=KEYS, count=REQUESTS):
+    cdf = []
+    total = 0.0
+    for i in xrange(1, n + 1):
+        total += 1.0 / i ** s
+        cdf.append(total)
+    return ['key:%d' % bisect(cdf, random.random() * total)
+            for _ in xrange(count)]
+
+
+def main():
+    random.seed(0)
+    for s in (0.8, 1.0, 1.2):
+        trace = zipf_trace(s)
+        for cls in (LegacyLocalCached, LocalCached):
+            backend = Backend()
+            mc = cls(backend, size=SIZE)
+            t = time.time()
+            for key in trace:
+                mc.get(key)
+            cost = time.time() - t
+            print 'zipf s=%.1f %-18s hit ratio %.3f  %.2f us/get' % (
+                s, cls.__name__, 1 - float(backend.gets) / len(trace),
+                cost / len(trace) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+""" bench_version.py
+
+cost of computing VersionedLocalCached versions of large values: md5 of
+the serialized value, as before, against the current fingerprint.
+"""
+
+from hashlib import md5
+from timeit import timeit
+
+import cmemcached
+from douban.mc.wrapper import fingerprint
+
+N = 200
+
+
+def main():
+    values = [
+        ('900KB str', 'x' * 900000),
+        ('10k-item dict', dict(('key%d' % i, range(10)) for i in xrange(10000))),
+        ('100k-int list', range(100000)),
+    ]
+    for name, value in values:
+        serialized, flag = cmemcached.prepare(value, 0)
+        prepare = timeit(lambda: cmemcached.prepare(value, 0), number=N) / N
+        old = timeit(lambda: md5(serialized).hexdigest(), number=N) / N
+        new = timeit(lambda: fingerprint(serialized), number=N) / N
+        print '%-14s %7d bytes  prepare %8.1f us  md5 %8.1f us  fingerprint %8.1f us' % (
+            name, len(serialized), prepare * 1e6, old * 1e6, new * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+""" bench_wrappers.py
+
+per call overhead of the wrapper chains built by MCManager.parse_config
+(and of LocalCached and SyncMC on top of a manager), over a client doing
+nothing.
+"""
+
+from timeit import repeat
+
+import douban.mc
+from douban.mc import MCManager
+from douban.mc.wrapper import LocalCached, SyncMC
+
+N = 100000
+REPEAT = 5
+
+
+class Client(object):
+    " a client doing nothing, every key is routed to the same server "
+    def get_host_by_key(self, key):
+        return 'localhost:11211'
+
+    def _nothing(self, *args, **kwargs):
+        return True
+
+    delete = incr = touch = set = _nothing
+    delete_multi = set_multi = _nothing
+
+
+# every client of the chains does nothing
+douban.mc.create_mc = lambda addr, **kwargs: Client()
+
+SERVERS = ['localhost:11211']
+PLAIN = {'servers': SERVERS}
+
+CONFIGS = [
+    ('manager', PLAIN),
+    ('adjust', {'servers': SERVERS, 'new_servers': SERVERS}),
+    ('replicated', {'servers': SERVERS, 'backup_servers': SERVERS}),
+    ('replicated(adjust)', {'servers': SERVERS, 'new_servers': SERVERS,
+                            'backup_servers': SERVERS}),
+    ('hot(replicated(adjust))', {'servers': SERVERS, 'new_servers': SERVERS,
+                                 'backup_servers': SERVERS,
+                                 'hot_keys': True}),
+]
+
+STACKS = [('client', Client)] + [
+    (name, lambda config=config: MCManager(config))
+    for name, config in CONFIGS
+] + [
+    ('local_cached', lambda: LocalCached(MCManager(PLAIN))),
+    ('sync', lambda: SyncMC(MCManager(PLAIN), MCManager(PLAIN))),
+]
+
+CALLS = [
+    ('delete', lambda mc: mc.delete('key')),
+    ('incr', lambda mc: mc.incr('key', 1)),
+    ('touch', lambda mc: mc.touch('key', 10)),
+    ('delete_multi', lambda mc: mc.delete_multi(['key'])),
+]
+
+
+def main():
+    base = {}
+    for stack, create in STACKS:
+        mc = create()
+        for call, func in CALLS:
+            cost = min(repeat(lambda: func(mc), number=N, repeat=REPEAT)) / N
+            base.setdefault(call, cost)
+            print '%-24s %-13s %6.2f us/call, %6.2f us over client' % (
+                stack, call, cost * 1e6, (cost - base[call]) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,8 @@ from douban.utils import hashdict
 from douban.utils.slog import log as slog
 from functools import wraps
 
+from .util import BatchQueue
+
 log = lambda message: slog('memcached', message)
 
 def create_mc(addr, **kwargs):
@@ -26,40 +28,117 @@ def create_mc(addr, **kwargs):
 
 MUTABLE_ATTR = ('set', 'delete', 'set_multi', 'delete_multi')
 
-def async_clean(func, async):
+def _keys_to_clean(arg_with_sense):
+    if isinstance(arg_with_sense, basestring):
+        return [arg_with_sense]
+    try:
+        return list(arg_with_sense)
+    except TypeError:
+        raise Exception('calling MCManager with wrong type argument')
+
+def async_clean(func, async, queue=None, multi=False):
+    """ wrap a writer so that the keys it fails to write are given to
+        `async` one by one, or put in `queue` to be cleaned in bulk, and
+        given to `async` when it is full.
+
+        *_multi writers are called with return_failure=True, so that only
+        the keys which failed are cleaned.
+    """
     @wraps(func)
     def _(arg_with_sense, *a, **kw):
-        r = func(arg_with_sense, *a, **kw)
-        if not r:
-            if isinstance(arg_with_sense, str):
-                async(arg_with_sense)
-            elif isinstance(arg_with_sense, list) or \
-                    isinstance(arg_with_sense, dict):
-                for k in arg_with_sense:
-                    async(k)
+        if multi:
+            if hasattr(arg_with_sense, 'next'):
+                # a generator would be used up by the writer
+                arg_with_sense = list(arg_with_sense)
+            return_failure = kw.get('return_failure', False)
+            kw['return_failure'] = True
+            r = func(arg_with_sense, *a, **kw)
+            if isinstance(r, tuple):
+                ok, failed = r
             else:
-                raise Exception('calling MCManager with wrong type argument')
+                ok = r
+                failed = [] if r else _keys_to_clean(arg_with_sense)
+            if not return_failure:
+                r = ok
+        else:
+            r = func(arg_with_sense, *a, **kw)
+            failed = [] if r else _keys_to_clean(arg_with_sense)
+        for k in failed:
+            # inline when the queue is full
+            if queue is None or not queue.put(k):
+                async(k)
         return r
     return _
 
 
 class MCManager(object):
-    def __init__(self, config, async_cleaner=None, **kwargs):
+    """ memcached clients built from a config, see parse_config()
+
+        Keys which fail to be written are given to `async_cleaner(key)`
+        from the writing thread, or, with `bulk_cleaner`, queued in
+        `clean_queue` and given to `bulk_cleaner(keys)` in deduplicated
+        batches from a background thread. Once `clean_queue` is full, they
+        are cleaned from the writing thread.
+
+        Values memoized by the RequestScopes given to add_scope() are
+        dropped when their keys are written through the manager.
+    """
+    def __init__(self, config, async_cleaner=None, bulk_cleaner=None,
+                 **kwargs):
         self.mc = None
         self.mc_config_path = None
         self.mc_config_version = None
         self.mc_config = None
         self.mc_config_change_history = []
         self.cfgreloader = None
+        self.clean_queue = None
+        self.scopes = []
         self.kwargs = kwargs
         self.parse_config(config)
-        if async_cleaner is not None:
+        if bulk_cleaner is not None:
+            self.clean_queue = BatchQueue(
+                    lambda items: bulk_cleaner(items.keys()), retries=3,
+                    name='mc-async-clean')
+        if async_cleaner is not None or bulk_cleaner is not None:
             # replace set/set_multi/delete/delete_multi behaviour
             # with wrapped edtion
             for attr in MUTABLE_ATTR:
-                method = getattr(self.mc, attr)
-                new_method = async_clean(method, async_cleaner)
-                setattr(self.mc, attr, new_method)
+                new_method = async_clean(self._writer(attr),
+                                         async_cleaner or
+                                         (lambda key: bulk_cleaner([key])),
+                                         self.clean_queue,
+                                         multi=attr.endswith('_multi'))
+                setattr(self, attr, new_method)
+
+    def _writer(self, attr):
+        multi = attr.endswith('_multi')
+        # looked up on each call, the wrappers of mc have __slots__
+        def method(*a, **kw):
+            if self.scopes and a:
+                if multi:
+                    if hasattr(a[0], 'next'):
+                        # a generator would be used up by the scopes
+                        a = (list(a[0]),) + a[1:]
+                    keys = a[0]
+                else:
+                    keys = a[:1]
+                for scope in self.scopes:
+                    scope.forget(keys)
+            return getattr(self.mc, attr)(*a, **kw)
+        method.__name__ = attr
+        return method
+
+    def add_scope(self, scope):
+        """ drop the values memoized by the RequestScope `scope` for the
+            keys written through the manager within it """
+        from .wrapper import KEY_WRITERS, MULTI_WRITERS
+        if scope in self.scopes:
+            return
+        self.scopes.append(scope)
+        for attr in KEY_WRITERS + MULTI_WRITERS + ('set', 'cas'):
+            # the writers wrapped by async_clean check the scopes already
+            if attr not in self.__dict__:
+                setattr(self, attr, self._writer(attr))
 
     def parse_config(self, config):
         cfgreloader_conf = config.get('cfgreloader', {})
@@ -81,27 +160,72 @@ class MCManager(object):
         disabled = config.get('disabled', False)
         in_disabled_list = hostname in config.get('disabled_client_hosts', [])
         disabled_via_env = os.environ.get('DOUBAN_CORELIB_DISABLE_MC', False)
-        if disabled or in_disabled_list or disabled_via_env:
-            from .debug import FakeMemcacheClient
-            _mc = FakeMemcacheClient()
-        else:
-            _mc = create_mc(config.get('servers'), **self.kwargs)
+        disabled = disabled or in_disabled_list or disabled_via_env
 
         from .wrapper import AdjustMC, Replicated
+        async_repair = config.get('async_repair', False)
         new_servers = config.get('new_servers',[])
-        if new_servers:
-            _mc = AdjustMC(_mc, create_mc(new_servers, **self.kwargs))
+        old_keys = None
+        if new_servers and config.get('old_keys_dump'):
+            from .migrate import load_old_keys
+            old_keys = load_old_keys(config['old_keys_dump'])
+
+        def create_primary(async_migrate=False):
+            if disabled:
+                from .debug import FakeMemcacheClient
+                mc = FakeMemcacheClient()
+            else:
+                mc = create_mc(config.get('servers'), **self.kwargs)
+            if new_servers:
+                migrators = None
+                if async_migrate and not disabled:
+                    # clients of the background thread
+                    migrators = (create_mc(config.get('servers'),
+                                           **self.kwargs),
+                                 create_mc(new_servers, **self.kwargs))
+                mc = AdjustMC(mc, create_mc(new_servers, **self.kwargs),
+                              migrators=migrators, old_keys=old_keys)
+            return mc
+
+        _mc = create_primary(async_repair)
 
         backup_servers = config.get('backup_servers',[])
         if backup_servers:
-            _mc = Replicated(_mc, create_mc(backup_servers, **self.kwargs))
+            hedge = None
+            hedged_reads = config.get('hedged_reads')
+            if hedged_reads and not disabled:
+                from .hedge import HedgedReader
+                hedge = HedgedReader(
+                    create_primary,
+                    lambda: create_mc(backup_servers, **self.kwargs),
+                    percentile=0.95 if hedged_reads is True else hedged_reads)
+            replica_writer = None
+            if config.get('async_replica_writes'):
+                replica_writer = create_mc(backup_servers, **self.kwargs)
+            repair_writer = None
+            if async_repair:
+                repair_writer = create_primary()
+            _mc = Replicated(_mc, create_mc(backup_servers, **self.kwargs),
+                             repair_writer=repair_writer, hedge=hedge,
+                             replica_writer=replica_writer,
+                             replica_overflow=config.get('replica_overflow',
+                                                         'delete'))
+
+        hot_keys = config.get('hot_keys')
+        if hot_keys:
+            from .wrapper import HotKeyCached
+            _mc = HotKeyCached(_mc, **(hot_keys if isinstance(hot_keys, dict)
+                                       else {}))
 
         if config.get('log_every_actions', False) and os.getpid() % 25 == 0:
             from douban.mc.debug import LogMemcache
             _mc = LogMemcache(_mc)
 
         self.mc_config = config
-        self.mc = _mc
+        old, self.mc = self.mc, _mc
+        if old is not None and hasattr(old, 'stop'):
+            # requests still using old do without its background threads
+            old.stop()
 
         if self.mc_config_path:
             try:
@@ -153,7 +277,8 @@ class MCManager(object):
         return 'MCManager (%r)' % self.mc
 
 _clients = {}
-def mc_from_config(config, use_cache = True, async_cleaner = None, **kwargs):
+def mc_from_config(config, use_cache = True, async_cleaner = None,
+                   bulk_cleaner = None, **kwargs):
     if isinstance(config, basestring):
         config = read_config(config, 'mc')
 
@@ -164,7 +289,8 @@ def mc_from_config(config, use_cache = True, async_cleaner = None, **kwargs):
         if mc:
             return mc
 
-    mc = MCManager(config, async_cleaner = async_cleaner, **kwargs)
+    mc = MCManager(config, async_cleaner = async_cleaner,
+                   bulk_cleaner = bulk_cleaner, **kwargs)
     if use_cache and cache_key:
         _clients[cache_key] = mc
 
@@ -9,6 +9,8 @@ import sys
 from itertools import izip
 from cPickle import dumps
 
+import cmemcached
+
 class LocalMemcache(object):
 
     def __init__(self):
@@ -19,7 +21,10 @@ class LocalMemcache(object):
         self.dataset[key] = (val, version + 1)
         return True
 
-    def add(self, key, val):
+    def set_raw(self, key, data, time=0, flag=0):
+        return self.set(key, cmemcached.restore(data, flag), time)
+
+    def add(self, key, val, time=0):
         if not self.dataset.has_key(key):
             self.dataset[key] = (val, 1)
             return True
@@ -91,14 +96,18 @@ class FakeMemcacheClient(object):
     def set(self, key, val, expire_secs=0, compress=True):
         return 1
 
-    def set_multi(self, values, expire_secs=0, compress=True):
+    def set_raw(self, key, data, expire_secs=0, flag=0):
         return 1
 
+    def set_multi(self, values, expire_secs=0, compress=True,
+                  return_failure=False):
+        return (1, []) if return_failure else 1
+
     def delete(self, key, timeout=0):
         return 1
 
-    def delete_multi(self, keys):
-        return 1
+    def delete_multi(self, keys, return_failure=False):
+        return (1, []) if return_failure else 1
 
     def get(self, key):
         return None
@@ -192,3 +201,7 @@ class LogMemcache:
 
     def close(self):
         self.mc.close()
+
+    def stop(self, timeout=5):
+        if hasattr(self.mc, 'stop'):
+            self.mc.stop(timeout)
@@ -5,28 +5,35 @@
 
 import inspect
 from functools import wraps
-import sys
 import time
+import math
+import random
 import struct
+import array
+from string import Formatter
 from warnings import warn
 
 from douban.utils import format, Empty
 
+from .util import SingleFlight
+
 
 _MC_CHUNK_SIZE = 1000000 - 1000 # from python-libmemcached, split_mc.h
+_REFRESH_MUTEX_EXPIRE = 10
 
 
 def gen_key(key_pattern, arg_names, defaults, *a, **kw):
     return gen_key_factory(key_pattern, arg_names, defaults)(*a, **kw)
 
 def gen_key_factory(key_pattern, arg_names, defaults):
-    args = dict(zip(arg_names[-len(defaults):], defaults)) if defaults else {}
+    call_args = _args_factory(arg_names, defaults)
+    compiled = compile_key_pattern(key_pattern, arg_names, defaults)
     if callable(key_pattern):
         names = inspect.getargspec(key_pattern)[0]
     def gen_key(*a, **kw):
-        aa = args.copy()
-        aa.update(zip(arg_names, a))
-        aa.update(kw)
+        aa = call_args(a, kw)
+        if compiled is not None:
+            return compiled(*a, **kw), aa
         if callable(key_pattern):
             key = key_pattern(*[aa[n] for n in names])
         else:
@@ -34,37 +41,233 @@ def gen_key_factory(key_pattern, arg_names, defaults):
         return key and key.replace(' ','_'), aa
     return gen_key
 
-def cache(key_pattern, mc, expire=0, max_retry=0):
+_missing = object()
+_formatter = Formatter()
+
+def _args_factory(arg_names, defaults, exclude=()):
+    """return a function of the positional and keyword args of a call,
+    returning all its args by name, defaults included, but `exclude`"""
+    args = dict(zip(arg_names[-len(defaults):], defaults)) if defaults else {}
+    def call_args(a, kw):
+        aa = args.copy()
+        aa.update(zip(arg_names, a))
+        aa.update(kw)
+        for name in exclude:
+            aa.pop(name, None)
+        return aa
+    return call_args
+
+def _arg_factory(name, arg_names, defaults, default=_missing):
+    """return a function of the positional and keyword args of a call,
+    returning its arg `name` without building the dict of all its args"""
+    if name not in arg_names:
+        return lambda a, kw: default
+    i = arg_names.index(name)
+    defaults = dict(zip(arg_names[-len(defaults):], defaults)) if defaults else {}
+    default = defaults.get(name, default)
+    def get_arg(a, kw):
+        if i < len(a):
+            return a[i]
+        if name in kw or default is _missing:
+            return kw[name]
+        return default
+    return get_arg
+
+def compile_key_pattern(key_pattern, arg_names, defaults):
+    """compile `key_pattern` into a function of the call args returning the
+    key, or return None if the pattern is not simple enough.
+
+    Each field of the pattern is mapped to the position of its argument at
+    decoration time, so a call only picks its values out of `a` and `kw`
+    and hands them to a prepared `str.format` template; non-ASCII unicode
+    args go through `string.Formatter` like douban.utils.format.
+    """
+    if callable(key_pattern):
+        names = inspect.getargspec(key_pattern)[0]
+        template = None
+    elif isinstance(key_pattern, basestring) and '%' not in key_pattern:
+        names = []
+        parts = []
+        try:
+            parsed = list(Formatter().parse(key_pattern))
+        except ValueError:
+            return None
+        for literal, field, spec, conversion in parsed:
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+            if field.isdigit() and int(field) < len(arg_names):
+                field = arg_names[int(field)]
+            if field not in arg_names or '{' in spec:
+                return None
+            if field not in names:
+                names.append(field)
+            parts.append('{%d%s%s}' % (names.index(field),
+                                       conversion and '!' + conversion or '',
+                                       spec and ':' + spec or ''))
+        template = key_pattern[:0].join(parts)
+    else:
+        return None
+
+    if any(n not in arg_names for n in names):
+        return None
+    defaults = dict(zip(arg_names[-len(defaults):], defaults)) if defaults else {}
+    slots = [(arg_names.index(n), n, defaults.get(n, _missing)) for n in names]
+
+    def gen_key(*a, **kw):
+        n = len(a)
+        values = [a[i] if i < n else
+                  kw[name] if name in kw or default is _missing else default
+                  for i, name, default in slots]
+        if template is None:
+            key = key_pattern(*values)
+        else:
+            try:
+                key = template.format(*values)
+            except UnicodeEncodeError:
+                # a unicode arg in a str pattern, as douban.utils.format
+                key = _formatter.vformat(template, values, {})
+        return key and key.replace(' ', '_')
+    return gen_key
+
+def key_factory(key_pattern, arg_names, defaults):
+    "like gen_key_factory, but the returned function only returns the key"
+    compiled = compile_key_pattern(key_pattern, arg_names, defaults)
+    if compiled is not None:
+        return compiled
+    gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+    return lambda *a, **kw: gen_key(*a, **kw)[0]
+
+class _Stored(object):
+    "a cached value together with the time it should be refreshed at"
+    delta = 0
+
+    def __init__(self, value, deadline, delta=0):
+        self.value = value
+        self.deadline = deadline
+        self.delta = delta # seconds spent computing the value
+
+def _store(mc, key, compute, expire, stale, early=0, envelope=False):
+    t = time.time()
+    r = compute()
+    if r is not None:
+        if (stale or early or envelope) and expire:
+            now = time.time()
+            mc.set(key, _Stored(r, now + expire, now - t), expire + stale)
+        else:
+            mc.set(key, r, expire)
+    return r
+
+def _recompute_early(stored, now, beta):
+    """XFetch: recompute before the deadline with a probability growing as
+    the deadline gets closer and as the value gets more expensive"""
+    return now - stored.delta * beta * math.log(1 - random.random()) \
+            >= stored.deadline
+
+def _load(mc, key, compute, expire, max_retry, stale, early=0,
+          envelope=False):
+    r = None
+
+    # anti miss-storm
+    retry = max_retry
+    while r is None and retry > 0:
+        # when node is down, add() will failed
+        if mc.add(key + '#mutex', 1, int(max_retry * 0.1)):
+            break
+        time.sleep(0.1)
+        r = mc.get(key)
+        if isinstance(r, _Stored):
+            r = r.value
+        retry -= 1
+
+    if r is None:
+        r = _store(mc, key, compute, expire, stale, early, envelope)
+        if max_retry > 0:
+            mc.delete(key + '#mutex')
+    return r
+
+def _refresh(mc, key, compute, expire, stale, early=0, envelope=False):
+    try:
+        return _store(mc, key, compute, expire, stale, early, envelope)
+    finally:
+        mc.delete(key + '#mutex')
+
+def _cached_call(mc, key, compute, expire=0, max_retry=0, force=False,
+                 flight=None, stale=0, early=0, ahead=None):
+    # with a RefreshAhead `ahead`, values are stored with their deadline,
+    # and reads are counted against the deadline of the stored value
+    envelope = ahead is not None
+    r = mc.get(key) if not force else None
+    if isinstance(r, _Stored):
+        now = time.time()
+        if envelope:
+            ahead.read(key, expire, r.deadline, mc, _store, key, compute,
+                       expire, stale, early, envelope)
+        if r.deadline <= now:
+            # serve the stale value unless we win the refresh lease
+            if stale and not flight.running(key) and \
+                    mc.add(key + '#mutex', 1, _REFRESH_MUTEX_EXPIRE):
+                return flight.do(key, _refresh, mc, key, compute, expire,
+                                 stale, early, envelope)
+        elif early and _recompute_early(r, now, early):
+            if flight is None:
+                return _store(mc, key, compute, expire, stale, early,
+                              envelope)
+            if not flight.running(key):
+                return flight.do(key, _store, mc, key, compute, expire,
+                                 stale, early, envelope)
+        return r.value
+    if r is not None:
+        return r
+    if flight is not None:
+        r = flight.do(key, _load, mc, key, compute, expire, max_retry,
+                      stale, early, envelope)
+    else:
+        r = _load(mc, key, compute, expire, max_retry, stale, early,
+                  envelope)
+    if envelope and expire:
+        ahead.read(key, expire, time.time() + expire, mc, _store, key,
+                   compute, expire, stale, early, envelope)
+    return r
+
+def cache(key_pattern, mc, expire=0, max_retry=0, single_flight=False,
+          stale=0, early_recompute=False, refresh_ahead=None):
+    """cache the return value of a function in mc.
+
+    With `single_flight`, concurrent misses of one key in this process share
+    a single call of the function, and the `#mutex` lease (`max_retry`) only
+    guards against other processes.
+
+    With `stale`, the value is kept `stale` seconds longer than `expire`.
+    During that time it is served as is while one caller refreshes it, so
+    a hot key never blocks on its expiration. `stale` implies `single_flight`.
+
+    With `early_recompute`, the time spent computing the value is stored
+    along with it, and each read before `expire` recomputes the value with
+    a probability growing as `expire` gets closer, weighted by that time
+    (XFetch). A number is used as the beta factor, True means 1.0; larger
+    values recompute earlier.
+
+    With `refresh_ahead`, a RefreshAhead pool, the value is stored with its
+    deadline, and keys read often enough before it are recomputed by the
+    pool, through its own clients, before they expire.
+    """
     def deco(f):
         arg_names, varargs, varkw, defaults = inspect.getargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
-        gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        gen_key = key_factory(key_pattern, arg_names, defaults)
+        flight = SingleFlight() if single_flight or stale else None
+        early = float(early_recompute)
         @wraps(f)
         def _(*a, **kw):
-            key, args = gen_key(*a, **kw)
+            key = gen_key(*a, **kw)
             if not key:
                 return f(*a, **kw)
             force = kw.pop('force', False)
-            r = mc.get(key) if not force else None
-
-            # anti miss-storm
-            retry = max_retry
-            while r is None and retry > 0:
-                # when node is down, add() will failed
-                if mc.add(key + '#mutex', 1, int(max_retry * 0.1)):
-                    break
-                time.sleep(0.1)
-                r = mc.get(key)
-                retry -= 1
-
-            if r is None:
-                r = f(*a, **kw)
-                if r is not None:
-                    mc.set(key, r, expire)
-                if max_retry > 0:
-                    mc.delete(key + '#mutex')
-
+            compute = lambda: f(*a, **kw)
+            r = _cached_call(mc, key, compute, expire, max_retry, force,
+                             flight, stale, early, refresh_ahead)
             if isinstance(r, Empty):
                 r = None
             return r
@@ -72,68 +275,202 @@ def cache(key_pattern, mc, expire=0, max_retry=0):
         return _
     return deco
 
-def pcache(key_pattern, mc, count=300, expire=0, max_retry=0):
+def cache_multi(key_pattern, mc, expire=0):
+    """cache a batch loader by item.
+
+    The first argument of the decorated function is a list of ids, and the
+    function returns a dict mapping id to value.  The key pattern refers to
+    that argument by its name, which is bound to each single id when the
+    keys are built, e.g.::
+
+        @cache_multi('user:{ids}')
+        def get_users(ids):
+            return dict((u.id, u) for u in User.gets(ids))
+
+    All keys are fetched with one get_multi, the function is called only
+    with the missed ids, and the results are stored with one set_multi.
+    """
+    def deco(f):
+        arg_names, varargs, varkw, defaults = inspect.getargspec(f)
+        if varargs or varkw:
+            raise Exception("do not support varargs")
+        if not arg_names:
+            raise Exception("function must take a list of ids as its first arg")
+        gen_key = key_factory(key_pattern, arg_names, defaults)
+        ids_name = arg_names[0]
+        @wraps(f)
+        def _(*a, **kw):
+            force = kw.pop('force', False)
+            if a:
+                ids, a = a[0], a[1:]
+            elif ids_name in kw:
+                ids = kw.pop(ids_name)
+            else:
+                raise TypeError("%s() takes the list of ids as %r"
+                                % (f.__name__, ids_name))
+            keys = {}
+            for i in ids:
+                if i not in keys:
+                    keys[i] = gen_key(i, *a, **kw)
+            cached = {}
+            if not force:
+                cached = mc.get_multi([k for k in keys.itervalues() if k])
+
+            r = {}
+            missed = []
+            for i, key in keys.iteritems():
+                v = cached.get(key) if key else None
+                if v is None:
+                    missed.append(i)
+                elif not isinstance(v, Empty):
+                    r[i] = v
+
+            if missed:
+                rs = f(missed, *a, **kw) or {}
+                values = {}
+                for i in missed:
+                    v = rs.get(i)
+                    if v is None:
+                        continue
+                    if keys[i]:
+                        values[keys[i]] = v
+                    if not isinstance(v, Empty):
+                        r[i] = v
+                if values:
+                    mc.set_multi(values, expire)
+            return r
+        _.original_function = f
+        return _
+    return deco
+
+def _get_segments(mc, key, compute, start, limit, segment, expire=0,
+                  force=False):
+    """serve [start, start+limit) from pages of `segment` items.
+
+    Page i is stored under "key#i" together with the generation stored
+    under `key`, so deleting `key` still invalidates the whole list. The
+    generation and the pages are read with one get_multi, and each run of
+    missing pages is computed with one call of `compute(start, limit)`,
+    which returns (n, items).
+    """
+    first, last = start // segment, (start + limit - 1) // segment
+    keys = ['%s#%d' % (key, i) for i in xrange(first, last + 1)]
+    got = mc.get_multi([key] + keys)
+    gen = got.get(key)
+    if not isinstance(gen, str):
+        # missing, or the whole list cached by pcache without `segment`
+        gen = '%x' % random.getrandbits(32)
+        mc.set(key, gen, expire)
+
+    pages = [None] * len(keys)
+    if not force:
+        for i, k in enumerate(keys):
+            page = got.get(k)
+            if page is not None and page[0] == gen:
+                pages[i] = page[1:]
+
+    values = {}
+    i = 0
+    while i < len(keys):
+        if pages[i] is not None:
+            i += 1
+            continue
+        end = i
+        while end < len(keys) and pages[end] is None:
+            end += 1
+        n, items = compute((first + i) * segment, (end - i) * segment)
+        for j in xrange(i, end):
+            offset = (j - i) * segment
+            pages[j] = (n, items[offset:offset + segment])
+            values[keys[j]] = (gen,) + pages[j]
+        i = end
+    if values:
+        mc.set_multi(values, expire)
+
+    r = []
+    for n, items in pages:
+        r.extend(items)
+    offset = start - first * segment
+    return pages[0][0], r[offset:offset + limit]
+
+def pcache(key_pattern, mc, count=300, expire=0, max_retry=0,
+           single_flight=False, stale=0, early_recompute=False, segment=0):
+    """cache the first `count` items of a paginated function.
+
+    With `segment`, the list is cached in pages of `segment` items instead,
+    and only the pages covering the requested range are fetched or computed,
+    with no limit on how deep the pagination goes. The function must then
+    take `start` too, and `single_flight`, `stale`, `early_recompute` do not
+    apply.
+    """
     def deco(f):
         arg_names, varargs, varkw, defaults = inspect.getargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
         if not ('limit' in arg_names):
             raise Exception("function must has 'limit' in args")
-        gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        if segment and not ('start' in arg_names):
+            raise Exception("function must has 'start' in args")
+        gen_key = key_factory(key_pattern, arg_names, defaults)
+        get_start = _arg_factory('start', arg_names, defaults, 0)
+        get_limit = _arg_factory('limit', arg_names, defaults)
+        # the other args, only built to call f
+        call_args = _args_factory(arg_names, defaults, ('start', 'limit'))
+        flight = SingleFlight() if single_flight or stale else None
+        early = float(early_recompute)
         @wraps(f)
         def _(*a, **kw):
-            key, args = gen_key(*a, **kw)
-            start = args.pop('start', 0)
-            limit = args.pop('limit')
-            start = int(start)
-            limit = int(limit)
+            force = kw.pop('force', False)
+            key = gen_key(*a, **kw)
+            start = int(get_start(a, kw))
+            limit = int(get_limit(a, kw))
+            if segment and key and limit > 0:
+                compute = lambda s, l: (None, f(start=s, limit=l,
+                                                **call_args(a, kw)))
+                return _get_segments(mc, key, compute, start, limit, segment,
+                                     expire, force)[1]
             if not key or limit is None or start+limit > count:
                 return f(*a, **kw)
 
-            force = kw.pop('force', False)
-            r = mc.get(key) if not force else None
-
-            # anti miss-storm
-            retry = max_retry
-            while r is None and retry > 0:
-                # when node is down, add() will failed
-                if mc.add(key + '#mutex', 1, int(max_retry*0.1)):
-                    break
-                print >>sys.stderr, "@cache(): wait for ", key, 'to return'
-                time.sleep(0.1)
-                r = mc.get(key)
-                retry -= 1
-
-            if r is None:
-                r = f(limit=count, **args)
-                mc.set(key, r, expire)
-            mc.delete(key + '#mutex')
+            compute = lambda: f(limit=count, **call_args(a, kw))
+            r = _cached_call(mc, key, compute, expire, max_retry, force,
+                             flight, stale, early)
             return r[start:start+limit]
         _.original_function = f
         return _
     return deco
 
-def pcache2(key_pattern, mc, count=300, expire=0):
+def pcache2(key_pattern, mc, count=300, expire=0, segment=0):
+    "like pcache, for functions returning (total, items)"
     def deco(f):
         arg_names, varargs, varkw, defaults = inspect.getargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
         if not ('limit' in arg_names):
             raise Exception("function must has 'limit' in args")
-        gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        if segment and not ('start' in arg_names):
+            raise Exception("function must has 'start' in args")
+        gen_key = key_factory(key_pattern, arg_names, defaults)
+        get_start = _arg_factory('start', arg_names, defaults, 0)
+        get_limit = _arg_factory('limit', arg_names, defaults)
+        call_args = _args_factory(arg_names, defaults, ('start', 'limit'))
         @wraps(f)
         def _(*a, **kw):
-            key, args = gen_key(*a, **kw)
-            start = args.pop('start', 0)
-            limit = args.pop('limit')
+            force = kw.pop('force', False)
+            key = gen_key(*a, **kw)
+            start = get_start(a, kw)
+            limit = get_limit(a, kw)
+            if segment and key and limit > 0:
+                compute = lambda s, l: f(start=s, limit=l, **call_args(a, kw))
+                return _get_segments(mc, key, compute, int(start), int(limit),
+                                     segment, expire, force)
             if not key or limit is None or start+limit > count:
                 return f(*a, **kw)
 
             n = 0
-            force = kw.pop('force', False)
             d = mc.get(key) if not force else None
             if d is None:
-                n, r = f(limit=count, **args)
+                n, r = f(limit=count, **call_args(a, kw))
                 mc.set(key, (n, r), expire)
             else:
                 n, r = d
@@ -142,32 +479,116 @@ def pcache2(key_pattern, mc, count=300, expire=0):
         return _
     return deco
 
-def listcache(key_pattern, mc, expire=0, fmt='I'):
-    "cache list(int) using struct.pack, for append/prepend"
+def _struct_fmt(fmt, n):
+    # "300I" instead of "III...", when fmt is a single item
+    return '%d%s' % (n, fmt) if len(fmt) == 1 else fmt * n
+
+def _get_shards(mc, key, gen, n):
+    parts = mc.get_list(['%s#%s#%d' % (key, gen, i) for i in xrange(n)])
+    if None in parts:
+        return None
+    return ''.join(parts)
+
+def _set_shards(mc, key, packed, expire, size):
+    gen = '%x' % random.getrandbits(32)
+    step = _MC_CHUNK_SIZE // size * size
+    shards = dict(('%s#%s#%d' % (key, gen, i // step), packed[i:i + step])
+                  for i in xrange(0, len(packed), step))
+    mc.set_multi(shards, expire, compress=False)
+    header = (gen, len(shards))
+    mc.set(key + '#shards', header, expire)
+    return mc.set(key, header, expire)
+
+def _extend_list(mc, key, items, fmt, tail, shard):
+    data = struct.pack(_struct_fmt(fmt, len(items)), *items)
+    extend = mc.append if tail else mc.prepend
+    if shard:
+        header = mc.get(key + '#shards')
+        if header is None:
+            # evicted, whether the list is sharded is unknown
+            mc.delete(key)
+            return False
+        if header:
+            gen, n = header
+            if extend('%s#%s#%d' % (key, gen, n - 1 if tail else 0), data):
+                return True
+            # the shard is full or gone, rebuild the list on next read
+            mc.delete(key)
+            return False
+    return extend(key, data)
+
+def listcache_append(mc, key, items, fmt='I', shard=False):
+    """append items to a list cached by listcache, a sharded list only
+    touches its tail shard. Use it with `shard` instead of mc.append on
+    lists cached with `shard`."""
+    return _extend_list(mc, key, items, fmt, True, shard)
+
+def listcache_prepend(mc, key, items, fmt='I', shard=False):
+    "prepend items to a list cached by listcache, see listcache_append"
+    return _extend_list(mc, key, items, fmt, False, shard)
+
+def listcache(key_pattern, mc, expire=0, fmt='I', shard=False,
+              as_array=False):
+    """cache list(int) using struct.pack, for append/prepend
+
+    With `shard`, lists longer than `_MC_CHUNK_SIZE` are stored across
+    "key#<gen>#0", "key#<gen>#1", ... with (gen, number of shards) stored
+    under `key`, so deleting `key` still invalidates the list, and under
+    "key#shards" for appends, which holds 0 for lists kept whole. Such
+    lists must be extended with listcache_append/listcache_prepend(shard=True),
+    which invalidate them when "key#shards" is gone.
+
+    With `as_array`, an `array.array` of typecode `fmt` is returned, copied
+    straight from the cached buffer instead of unpacked into a tuple of
+    python ints.
+    """
     def deco(f):
         arg_names, varargs, varkw, defaults = inspect.getargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
-        gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        if as_array and (len(fmt) != 1 or fmt not in 'bBhHiIlLfd'):
+            raise Exception("fmt %r is not an array typecode" % fmt)
+        gen_key = key_factory(key_pattern, arg_names, defaults)
         size = struct.calcsize(fmt)
         @wraps(f)
         def _(*a, **kw):
-            key, args = gen_key(*a, **kw)
+            key = gen_key(*a, **kw)
             if not key:
                 return f(*a, **kw)
             force = kw.pop('force', False)
-            r = mc.get(key) if not force else None
-            if r and len(r) > _MC_CHUNK_SIZE:
-                # python-libmemcached会将大于`CHUNK_SIZE`的值split为多个再set
-                # 会让`append/prepend`行为不符合预期
-                # 这里认为接近`CHUNK_SIZE`的值都可能是有错的
-                r = None
+            r = None
+            if force:
+                pass
+            elif shard:
+                r = mc.get(key)
+                if isinstance(r, tuple):
+                    r = _get_shards(mc, key, *r)
+                elif r and len(r) > _MC_CHUNK_SIZE:
+                    r = None
+            else:
+                r = mc.get(key)
+                if r and len(r) > _MC_CHUNK_SIZE:
+                    # python-libmemcached会将大于`CHUNK_SIZE`的值split为多个再set
+                    # 会让`append/prepend`行为不符合预期
+                    # 这里认为接近`CHUNK_SIZE`的值都可能是有错的
+                    r = None
             if r is not None and len(r)%size == 0:
-                r = struct.unpack(fmt*(len(r)/size), r)
+                if as_array:
+                    r = array.array(fmt, r)
+                else:
+                    r = struct.unpack(_struct_fmt(fmt, len(r)/size), r)
             else:
                 r = f(*a, **kw)
                 if isinstance(r, (list, tuple)):
-                    mc.set(key, struct.pack(fmt*len(r), *r), expire, compress=False)
+                    packed = struct.pack(_struct_fmt(fmt, len(r)), *r)
+                    if shard and len(packed) > _MC_CHUNK_SIZE:
+                        _set_shards(mc, key, packed, expire, size)
+                    else:
+                        if shard:
+                            mc.set(key + '#shards', 0, expire)
+                        mc.set(key, packed, expire, compress=False)
+                    if as_array:
+                        r = array.array(fmt, packed)
                 else:
                     warn("func %s (%s) should return list or tuple" % (f.__name__, key))
             return r
@@ -180,10 +601,10 @@ def delete_cache(key_pattern,mc):
         arg_names, varargs, varkw, defaults = inspect.getargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
-        gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        gen_key = key_factory(key_pattern, arg_names, defaults)
         @wraps(f)
         def _(*a, **kw):
-            key, args = gen_key(*a, **kw)
+            key = gen_key(*a, **kw)
             r = f(*a, **kw)
             mc.delete(key)
             return r
@@ -208,20 +629,48 @@ def cache_in_obj(key, mc, expire=0):
         return _
     return deco
 
-def create_decorators(mc):
+def create_decorators(mc, scope=None):
+    """create the decorators bound to `mc`.
+
+    With `scope`, a RequestScope, values read by the decorators within the
+    scope are served from a per-request dict after the first lookup. When
+    `mc` is a MCManager, keys written through it within the scope, by the
+    decorators or not, are read again from mc.
+    """
+    if scope is not None:
+        from . import MCManager
+        from .wrapper import RequestCached
+        if isinstance(mc, MCManager):
+            mc.add_scope(scope)
+        mc = RequestCached(mc, scope)
+
     # 因为cache的调用有太多对expire参数的非关键字调用，因此没法用partial方式生成函数
 
-    def _cache(key_pattern, expire=0, mc=mc, max_retry=0):
-        return cache(key_pattern, mc, expire=expire, max_retry=max_retry)
+    def _cache(key_pattern, expire=0, mc=mc, max_retry=0, single_flight=False,
+               stale=0, early_recompute=False, refresh_ahead=None):
+        return cache(key_pattern, mc, expire=expire, max_retry=max_retry,
+                     single_flight=single_flight, stale=stale,
+                     early_recompute=early_recompute,
+                     refresh_ahead=refresh_ahead)
+
+    def _cache_multi(key_pattern, expire=0):
+        return cache_multi(key_pattern, mc, expire=expire)
 
-    def _pcache(key_pattern, count=300, expire=0, max_retry=0):
-        return pcache(key_pattern, mc, count=count, expire=expire, max_retry=max_retry)
+    def _pcache(key_pattern, count=300, expire=0, max_retry=0,
+                single_flight=False, stale=0, early_recompute=False,
+                segment=0):
+        return pcache(key_pattern, mc, count=count, expire=expire,
+                      max_retry=max_retry, single_flight=single_flight,
+                      stale=stale, early_recompute=early_recompute,
+                      segment=segment)
 
-    def _pcache2(key_pattern, count=300, expire=0):
-        return pcache2(key_pattern, count=count, expire=expire, mc=mc)
+    def _pcache2(key_pattern, count=300, expire=0, segment=0):
+        return pcache2(key_pattern, count=count, expire=expire, mc=mc,
+                       segment=segment)
 
-    def _listcache(key_pattern, expire=0):
-        return listcache(key_pattern, expire=expire, mc=mc)
+    def _listcache(key_pattern, expire=0, shard=False, as_array=False):
+        return listcache(key_pattern, expire=expire, mc=mc, shard=shard,
+                         as_array=as_array)
 
     def _cache_in_obj(key, expire=0):
          return cache_in_obj(key, expire=expire, mc=mc)
@@ -229,7 +678,7 @@ def create_decorators(mc):
     def _delete_cache(key_pattern):
         return delete_cache(key_pattern, mc=mc)
 
-    return dict(cache=_cache, pcache=_pcache,
+    return dict(cache=_cache, cache_multi=_cache_multi, pcache=_pcache,
                 pcache2=_pcache2, listcache=_listcache,
                 cache_in_obj=_cache_in_obj,
                 delete_cache=_delete_cache)
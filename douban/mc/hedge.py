@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+''' hedged reads between a primary and a backup memcached '''
+
+import os
+import sys
+import time
+import threading
+from Queue import Queue, Full
+from collections import deque
+
+from .util import ensure_started
+
+PRIMARY, BACKUP = 0, 1
+_STOP = object()
+
+
+class LatencyTracker(object):
+    " the latencies of the last `window` reads of a client "
+
+    def __init__(self, window=1000, every=100):
+        self.samples = deque(maxlen=window)
+        self.every = every
+        self.recorded = 0
+        self.cached = {}
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.recorded += 1
+        if self.recorded % self.every == 0:
+            self.cached = {}
+
+    def percentile(self, p):
+        r = self.cached.get(p)
+        if r is None:
+            samples = sorted(self.samples)
+            if not samples:
+                return None
+            r = self.cached[p] = samples[min(int(p * len(samples)),
+                                             len(samples) - 1)]
+        return r
+
+
+class _Hedge(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.results = {}       # PRIMARY or BACKUP -> (value, exc_info)
+
+    def deliver(self, which, value, exc_info):
+        with self.cond:
+            self.results[which] = (value, exc_info)
+            self.cond.notify_all()
+
+    def wait(self, which, timeout):
+        with self.cond:
+            if which not in self.results:
+                self.cond.wait(timeout)
+            return which in self.results
+
+    def winner(self, hedged):
+        " the first answer but None, or the primary one once all are in "
+        with self.cond:
+            while True:
+                for which in (PRIMARY, BACKUP):
+                    value, exc_info = self.results.get(which, (None, None))
+                    if value is not None:
+                        return value, which
+                if len(self.results) == (2 if hedged else 1):
+                    break
+                self.cond.wait()
+            return self._primary(), PRIMARY
+
+    def merged(self, hedged, keys):
+        """ the union of the dict answers in so far, the primary values
+            winning, once it holds every key of `keys` or all answers are
+            in; and whether the backup gave keys the primary did not """
+        with self.cond:
+            while True:
+                r = {}
+                for which in (BACKUP, PRIMARY):
+                    value, exc_info = self.results.get(which, (None, None))
+                    if value:
+                        r.update(value)
+                if all(k in r for k in keys) or \
+                        len(self.results) == (2 if hedged else 1):
+                    break
+                self.cond.wait()
+            if not r:
+                return self._primary() or {}, False
+            primary = self.results.get(PRIMARY, (None, None))[0] or {}
+            return r, len(r) > len(primary)
+
+    def _primary(self):
+        value, exc_info = self.results[PRIMARY]
+        if exc_info is not None and BACKUP not in self.results:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return value
+
+
+class _Pool(object):
+    " `workers` threads reading from their own clients made by `new_client()` "
+
+    def __init__(self, new_client, workers, max_pending, window, name):
+        self.new_client = new_client
+        self.workers = workers
+        self.name = name
+        self.queue = Queue(max_pending)
+        self.latency = LatencyTracker(window)
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.threads = []
+        self.pid = None
+
+    def _start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                # a thread of the parent may have held the queue's lock
+                self.queue = Queue(self.queue.maxsize)
+            threads = ensure_started(self, self._run, self.name,
+                                     self.workers)
+            if threads:
+                self.threads = threads
+
+    def _run(self, pid):
+        queue = self.queue
+        client = self.new_client()
+        while True:
+            task = queue.get()
+            if task is _STOP:
+                break
+            which, name, args, hedge = task
+            t = time.time()
+            try:
+                value = getattr(client, name)(*args)
+            except Exception:
+                hedge.deliver(which, None, sys.exc_info())
+            else:
+                hedge.deliver(which, value, None)
+            self.latency.record(time.time() - t)
+        if hasattr(client, 'close'):
+            client.close()
+
+    def submit(self, which, name, args, hedge):
+        if self.stopped:
+            return False
+        self._start()
+        # no read is queued behind the stop of the workers
+        with self.lock:
+            if self.stopped:
+                return False
+            try:
+                self.queue.put_nowait((which, name, args, hedge))
+            except Full:
+                return False
+        return True
+
+    def stop(self, timeout=None):
+        " end the workers once the queued reads are done "
+        with self.lock:
+            self.stopped = True
+            if self.pid != os.getpid():
+                return
+            threads = self.threads
+            for t in threads:
+                self.queue.put(_STOP)
+        for t in threads:
+            t.join(timeout)
+
+
+class HedgedReader(object):
+    """ read from a primary client, and from a backup one as well when the
+        primary has not answered after the `percentile` of its recent
+        latencies (`min_delay` at least); the first answer but None wins,
+        or with read_multi() both answers are merged.
+
+        Clients are not shared between threads, so reads run in two pools
+        of `workers` threads, one owning clients made by `new_primary()`
+        and the other clients made by `new_backup()`: a read of the backup
+        never waits behind slow reads of the primary. When `max_pending`
+        reads wait for a primary worker, reads are not hedged, and the
+        caller falls back to its own clients.
+
+        `latency` tracks both clients; `stats` counts the reads, the hedged
+        ones, those won by the backup and those done by the caller.
+        Once stop() is called, the caller does every read.
+    """
+
+    def __init__(self, new_primary, new_backup, percentile=0.95,
+                 min_delay=0.001, workers=8, max_pending=100, window=1000):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.pools = (_Pool(new_primary, workers, max_pending, window,
+                            'mc-hedged-read'),
+                      _Pool(new_backup, workers, max_pending, window,
+                            'mc-hedged-backup-read'))
+        self.latency = tuple(pool.latency for pool in self.pools)
+        self.stats = dict(reads=0, hedged=0, backup_wins=0, fallbacks=0)
+
+    def stop(self, timeout=None):
+        " end the workers and close their clients "
+        for pool in self.pools:
+            pool.stop(timeout)
+
+    def read(self, name, *args):
+        """ returns the value of a read method of the clients and whether
+            the backup was asked, or None if the caller has to read by
+            itself """
+        r = self._hedge(name, args)
+        if r is None:
+            return None
+        hedge, hedged = r
+        value, which = hedge.winner(hedged)
+        if which == BACKUP:
+            self.stats['backup_wins'] += 1
+        return value, hedged
+
+    def read_multi(self, name, keys):
+        """ read() for a read method of many keys returning a dict, such as
+            get_multi: when the backup is asked, both answers are merged """
+        r = self._hedge(name, (keys,))
+        if r is None:
+            return None
+        hedge, hedged = r
+        value, from_backup = hedge.merged(hedged, keys)
+        if from_backup:
+            self.stats['backup_wins'] += 1
+        return value, hedged
+
+    def _hedge(self, name, args):
+        hedge = _Hedge()
+        if not self.pools[PRIMARY].submit(PRIMARY, name, args, hedge):
+            self.stats['fallbacks'] += 1
+            return None
+        self.stats['reads'] += 1
+        delay = self.latency[PRIMARY].percentile(self.percentile)
+        if delay is None or delay < self.min_delay:
+            delay = self.min_delay
+        hedged = False
+        if not hedge.wait(PRIMARY, delay):
+            hedged = self.pools[BACKUP].submit(BACKUP, name, args, hedge)
+            if hedged:
+                self.stats['hedged'] += 1
+        return hedge, hedged
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+''' drain the old cluster of an AdjustMC into its new one '''
+
+import os
+import time
+import urllib
+from random import randint
+from itertools import islice
+
+from .util import CuckooFilter
+
+
+def read_keys(path):
+    """ keys of a key dump file, one key per line, or the output of
+        memcached's `lru_crawler metadump` ("key=... exp=... ...") """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('key='):
+                line = urllib.unquote(line.split(' ', 1)[0][4:])
+            if line:
+                yield line
+
+
+_old_keys = {}
+def load_old_keys(path):
+    """ a CuckooFilter of the keys in a key dump, for AdjustMC(old_keys=)
+
+        The filter is built once per dump file and process, and shared by
+        the clients configured with it until the file changes.
+    """
+    st = os.stat(path)
+    version = (st.st_mtime, st.st_size)
+    cached = _old_keys.get(path)
+    if cached is None or cached[0] != version:
+        # count, then stream the keys: a dump holds millions of them
+        capacity = sum(1 for k in read_keys(path))
+        keys = CuckooFilter.from_keys(read_keys(path), capacity)
+        cached = _old_keys[path] = (version, keys)
+    return cached[1]
+
+
+class Drainer(object):
+    """ replay a stream of keys through an AdjustMC, moving the values
+        still on its old cluster to the new one in batches
+
+        Values are read with one get_multi per batch, and copied with one
+        set_multi of those the new cluster does not hold yet after one
+        get_multi of it: as with AdjustMC, a value written to the new
+        cluster in between is overwritten. The values copied or found on
+        the new cluster are deleted from the old one with one delete_multi.
+        At most `rate` keys per second are read. With `checkpoint`, the
+        number of keys consumed is saved to that file after each batch, and
+        a later drain() of the same stream resumes from there. `stats`
+        counts the keys scanned, moved (routed elsewhere by the new
+        cluster), copied and deleted; `report` is called with it after
+        each batch.
+    """
+
+    def __init__(self, adjust_mc, batch_size=500, rate=5000, expire=None,
+                 checkpoint=None, report=None):
+        self.mc = adjust_mc
+        self.batch_size = batch_size
+        self.rate = rate
+        self.expire = expire
+        self.checkpoint = checkpoint
+        self.report = report
+        self.stats = dict(scanned=0, moved=0, copied=0, deleted=0)
+
+    def _load_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                return int(f.read().strip() or 0)
+        return 0
+
+    def _save_checkpoint(self, position):
+        if self.checkpoint:
+            tmp = self.checkpoint + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write('%d\n' % position)
+            os.rename(tmp, self.checkpoint)
+
+    def drain_batch(self, keys):
+        oldmc, newmc = self.mc.oldmc, self.mc.newmc
+        moved = self.mc.moved_keys(keys)
+        self.stats['moved'] += len(moved)
+        moved = self.mc.left_on_old(moved)
+        values = oldmc.get_multi(moved) if moved else {}
+        if values:
+            expire = self.expire
+            if expire is None:
+                expire = 3600 + randint(0, 3600)
+            # a value written to the new cluster already wins
+            present = newmc.get_multi(values.keys())
+            absent = dict((k, v) for k, v in values.iteritems()
+                          if k not in present)
+            copied = []
+            if absent:
+                _, failed = newmc.set_multi(absent, expire,
+                                            return_failure=True)
+                failed = set(failed)
+                copied = [k for k in absent if k not in failed]
+            done = present.keys() + copied
+            if done:
+                oldmc.delete_multi(done)
+                self.mc.forget(done)
+            self.stats['copied'] += len(copied)
+            self.stats['deleted'] += len(done)
+        self.stats['scanned'] += len(keys)
+
+    def drain(self, keys):
+        " drain every key of the iterable `keys`, returns stats "
+        position = self._load_checkpoint()
+        keys = iter(keys)
+        for _ in islice(keys, position):
+            pass
+        start = time.time()
+        scanned = 0
+        while True:
+            batch = list(islice(keys, self.batch_size))
+            if not batch:
+                break
+            self.drain_batch(batch)
+            position += len(batch)
+            scanned += len(batch)
+            self._save_checkpoint(position)
+            if self.report is not None:
+                self.report(self.stats)
+            if self.rate:
+                ahead = float(scanned) / self.rate - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return self.stats
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+''' refresh hot cached keys in background before they expire '''
+
+import os
+import sys
+import time
+import heapq
+import random
+import threading
+import traceback
+
+from .util import ensure_started
+
+# as the refresh lease of decorator.cache
+_MUTEX_EXPIRE = 10
+
+class RefreshAhead(object):
+    """ a bounded pool of threads refreshing hot keys of `cache()`
+
+        A value read `hot_reads` times before its deadline is scheduled to be
+        recomputed `ahead` (a fraction of `expire`) before it expires, so
+        readers of hot keys never see a miss. At most `max_pending` keys wait
+        in the schedule; others are skipped until they get hot again.
+
+        Processes reading the same hot key schedule it on their own: each
+        one refreshes it up to `jitter` (a fraction of the `ahead` time)
+        later than scheduled, under the `key#mutex` lease of cache(), and
+        skips it if the lease is held or the stored value has been
+        refreshed since.
+
+        Clients are not shared between threads: each worker stores the
+        values it recomputes through its own client for the client `mc` of
+        cache(), made once by `new_mc(mc)`, e.g. a new client of the same
+        config. A forked process starts with an empty schedule of its own.
+
+        `stats` counts the refreshes done, skipped and failed.
+    """
+
+    def __init__(self, new_mc, hot_reads=10, workers=2, max_pending=1000,
+                 ahead=0.1, max_tracked=100000, jitter=0.5):
+        self.new_mc = new_mc
+        self.hot_reads = hot_reads
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ahead = ahead
+        self.jitter = jitter
+        self.max_tracked = max_tracked
+        self.cond = threading.Condition()
+        self.reads = {}         # key -> [count, deadline]
+        self.scheduled = {}     # key -> (mc, func, args, deadline)
+        self.heap = []          # (time to refresh, key)
+        self.threads = []
+        self.pid = None
+        self.stats = dict(refreshed=0, skipped=0, failed=0)
+
+    def read(self, key, expire, deadline, mc, func, *args):
+        """ count a read of `key`, a value stored for `expire` seconds until
+            `deadline`, and schedule `func(client, *args)` once it is hot,
+            with the worker's own client for `mc` """
+        if not expire or deadline <= time.time():
+            return
+        self._forked()
+        with self.cond:
+            if key in self.scheduled:
+                self._start()
+                return
+            r = self.reads.get(key)
+            if r is None or abs(r[1] - deadline) > 1:
+                # first read of the key, or of a value stored since
+                r = self._track(key, deadline)
+            elif deadline < r[1]:
+                # the stored deadline, not the one guessed after a miss
+                r[1] = deadline
+            r[0] += 1
+            if r[0] < self.hot_reads:
+                return
+            del self.reads[key]
+            if len(self.heap) >= self.max_pending:
+                self.stats['skipped'] += 1
+                return
+            self.scheduled[key] = (mc, func, args, r[1])
+            ahead = expire * self.ahead * (1 - self.jitter * random.random())
+            heapq.heappush(self.heap, (r[1] - ahead, key))
+            self._start()
+            self.cond.notify()
+
+    def stop(self):
+        self._forked()
+        with self.cond:
+            self.stats['skipped'] += len(self.heap)
+            self.heap = []
+            self.scheduled.clear()
+            self.pid = None
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def _forked(self):
+        if self.pid is None or self.pid == os.getpid():
+            return
+        # a worker of the parent may have held cond, and its schedule is
+        # the parent's business
+        self.pid = None
+        self.cond = threading.Condition()
+        self.reads = {}
+        self.scheduled = {}
+        self.heap = []
+        self.threads = []
+
+    def _track(self, key, deadline):
+        if len(self.reads) >= self.max_tracked:
+            self.reads.clear()
+        r = self.reads[key] = [0, deadline]
+        return r
+
+    def _start(self):
+        threads = ensure_started(self, self._run, 'mc-refresh-ahead',
+                                 self.workers)
+        if threads:
+            self.threads = threads
+
+    def _next(self, pid):
+        with self.cond:
+            while self.pid == pid:
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    _, key = heapq.heappop(self.heap)
+                    return key, self.scheduled.pop(key)
+                self.cond.wait(self.heap[0][0] - now if self.heap else None)
+        return None, None
+
+    def _refresh(self, client, key, deadline, func, args):
+        """ returns False when another process is refreshing key, or has
+            stored a value of a later deadline """
+        if not client.add(key + '#mutex', 1, _MUTEX_EXPIRE):
+            return False
+        try:
+            stored = client.get(key)
+            if getattr(stored, 'deadline', 0) > deadline:
+                return False
+            func(client, *args)
+            return True
+        finally:
+            client.delete(key + '#mutex')
+
+    def _run(self, pid):
+        clients = {}
+        while True:
+            key, task = self._next(pid)
+            if task is None:
+                return
+            mc, func, args, deadline = task
+            try:
+                client = clients.get(mc)
+                if client is None:
+                    client = clients[mc] = self.new_mc(mc)
+                refreshed = self._refresh(client, key, deadline, func, args)
+            except Exception:
+                print >> sys.stderr, 'refresh %s failed:' % key
+                traceback.print_exc()
+                with self.cond:
+                    self.stats['failed'] += 1
+            else:
+                with self.cond:
+                    self.stats['refreshed' if refreshed else 'skipped'] += 1
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+''' a table of serialized values shared by processes through mmap '''
+
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+from cPickle import dumps, loads
+
+_MAGIC = 'DMCSHM02'
+# magic, sets, ways, slot size, stripes
+_FILE_HEADER = struct.Struct('<8sIIII')
+# key length, value length, flag, expires, last used
+_SLOT_HEADER = struct.Struct('<HIBdd')
+_USED = struct.Struct('<d')
+_USED_OFFSET = _SLOT_HEADER.size - _USED.size
+_DATA_OFFSET = mmap.PAGESIZE
+
+FLAG_STR = 0
+FLAG_PICKLE = 1
+
+
+class SegmentMismatch(Exception):
+    pass
+
+
+def _encode(key):
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
+
+
+class SharedSegment(object):
+    """ a set-associative table of `ways` slots per set in a file mapped by
+        every process opening `path`, e.g. a file under /dev/shm.
+
+        A slot holds one key and its serialized value, `slot_size` bytes at
+        most. Sets are guarded by `stripes` locks, each one a thread lock
+        plus a fcntl lock on one byte of the file. Inserting into a full set
+        evicts its least recently used slot.
+
+        The geometry, stripes included, is stored in the file, opening it
+        with another one raises SegmentMismatch; use a new path when
+        changing it.
+
+        fcntl locks belong to a process, not to a file descriptor: two
+        segments of the same path opened by one process do not exclude
+        each other, and closing one releases the locks of the other. Open
+        a path once per process and share the segment between its threads.
+    """
+
+    def __init__(self, path, size=64 << 20, slot_size=4096, ways=4,
+                 stripes=64):
+        self.path = path
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = max(1, size // (slot_size * ways))
+        self.stripes = min(stripes, self.sets)
+        self.locks = [threading.Lock() for i in range(self.stripes)]
+        self.stats = dict(hits=0, misses=0, evictions=0)
+        total = _DATA_OFFSET + self.sets * ways * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            self._init(total)
+            self.mm = mmap.mmap(self.fd, total)
+        except:
+            os.close(self.fd)
+            raise
+
+    def _init(self, total):
+        geometry = (_MAGIC, self.sets, self.ways, self.slot_size,
+                    self.stripes)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, total)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, _FILE_HEADER.pack(*geometry))
+                return
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            header = os.read(self.fd, _FILE_HEADER.size)
+            if len(header) < _FILE_HEADER.size or \
+                    _FILE_HEADER.unpack(header) != geometry:
+                raise SegmentMismatch('%s is not a segment of %r'
+                                      % (self.path, geometry[1:]))
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+
+    def close(self):
+        if self.fd is not None:
+            self.mm.close()
+            os.close(self.fd)
+            self.fd = None
+
+    @contextmanager
+    def _locked(self, set_index):
+        stripe = set_index % self.stripes
+        lock = self.locks[stripe]
+        with lock:
+            # fcntl locks are per process, the thread lock comes first
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 1 + stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 1 + stripe)
+
+    def _set_of(self, key):
+        return (zlib.crc32(key) & 0xffffffff) % self.sets
+
+    def _find(self, set_index, key):
+        mm = self.mm
+        klen = len(key)
+        start = _DATA_OFFSET + set_index * self.ways * self.slot_size
+        for off in xrange(start, start + self.ways * self.slot_size,
+                          self.slot_size):
+            kstart = off + _SLOT_HEADER.size
+            if struct.unpack_from('<H', mm, off)[0] == klen and \
+                    mm[kstart:kstart + klen] == key:
+                return off
+        return None
+
+    def _victim(self, set_index):
+        now = time.time()
+        start = _DATA_OFFSET + set_index * self.ways * self.slot_size
+        victim = None
+        for off in xrange(start, start + self.ways * self.slot_size,
+                          self.slot_size):
+            klen, _, _, expires, used = _SLOT_HEADER.unpack_from(self.mm, off)
+            if not klen or expires and expires <= now:
+                return off
+            if victim is None or used < victim[1]:
+                victim = off, used
+        self.stats['evictions'] += 1
+        return victim[0]
+
+    def get(self, key):
+        " the value of key, or None "
+        key = _encode(key)
+        set_index = self._set_of(key)
+        mm = self.mm
+        with self._locked(set_index):
+            off = self._find(set_index, key)
+            if off is not None:
+                klen, vlen, flag, expires, _ = \
+                        _SLOT_HEADER.unpack_from(mm, off)
+                now = time.time()
+                if expires and expires <= now:
+                    mm[off:off + 2] = '\0\0'
+                    off = None
+                else:
+                    _USED.pack_into(mm, off + _USED_OFFSET, now)
+                    start = off + _SLOT_HEADER.size + klen
+                    data = mm[start:start + vlen]
+        if off is None:
+            self.stats['misses'] += 1
+            return None
+        if flag == FLAG_STR:
+            self.stats['hits'] += 1
+            return data
+        try:
+            value = loads(data)
+        except Exception:
+            self.stats['misses'] += 1
+            self.delete(key)
+            return None
+        self.stats['hits'] += 1
+        return value
+
+    def set(self, key, value, ttl=0):
+        " store value, returns False if it does not fit in a slot "
+        key = _encode(key)
+        if isinstance(value, str):
+            data, flag = value, FLAG_STR
+        else:
+            data, flag = dumps(value, -1), FLAG_PICKLE
+        if _SLOT_HEADER.size + len(key) + len(data) > self.slot_size:
+            self.delete(key)
+            return False
+        now = time.time()
+        set_index = self._set_of(key)
+        mm = self.mm
+        with self._locked(set_index):
+            off = self._find(set_index, key)
+            if off is None:
+                off = self._victim(set_index)
+            # a process killed while writing leaves an empty slot: the key
+            # length is cleared first and written last
+            mm[off:off + 2] = '\0\0'
+            start = off + _SLOT_HEADER.size
+            mm[start:start + len(key)] = key
+            start += len(key)
+            mm[start:start + len(data)] = data
+            _SLOT_HEADER.pack_into(mm, off, 0, len(data), flag,
+                                   ttl and now + ttl, now)
+            struct.pack_into('<H', mm, off, len(key))
+        return True
+
+    def delete(self, key):
+        key = _encode(key)
+        set_index = self._set_of(key)
+        with self._locked(set_index):
+            off = self._find(set_index, key)
+            if off is not None:
+                self.mm[off:off + 2] = '\0\0'
+
+    def wipe(self):
+        " drop the objs of every process using the segment "
+        size = self.ways * self.slot_size
+        empty = '\0' * size
+        for set_index in xrange(self.sets):
+            start = _DATA_OFFSET + set_index * size
+            with self._locked(set_index):
+                self.mm[start:start + size] = empty
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
+import struct
+import threading
+import traceback
+from array import array
+from hashlib import md5
+from random import randrange
 from cStringIO import StringIO
 from operator import itemgetter
 
 from douban.utils.debug import ObjCallLogger
 
 class LogMixin(object):
+    __slots__ = ()
 
     def start_log(self):
         self.mc = ObjCallLogger(self.mc)
@@ -39,3 +49,446 @@ class LogMixin(object):
             print >> sio
         return sio.getvalue()
 
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class SingleFlight(object):
+    " share one in-flight call per key among the threads of this process "
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def running(self, key):
+        return key in self.calls
+
+    def do(self, key, func, *a, **kw):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+        try:
+            call.result = func(*a, **kw)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+
+class _ScopeState(object):
+    def __init__(self):
+        self.memo = {}
+        self.flight = SingleFlight()
+
+    def get(self, key, load):
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        r = self.flight.do(key, load, key)
+        if r is not None:
+            self.memo[key] = r
+        return r
+
+class RequestScope(object):
+    """ a request scope entered and exited by the app, e.g.::
+
+            scope = RequestScope()
+            decorators = create_decorators(mc, scope=scope)
+
+            with scope:
+                handle_request()
+
+        values read within a scope are kept in a per-request dict, which is
+        dropped when the scope ends. Threads working for the same request
+        can share it with `scope.join(scope.current())`. Keys written within
+        the scope through the MCManager of the decorators are dropped from
+        it, see MCManager.add_scope().
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def begin(self):
+        self.local.state = _ScopeState()
+        return self.local.state
+
+    def end(self):
+        self.local.state = None
+
+    def join(self, state):
+        self.local.state = state
+
+    def current(self):
+        return getattr(self.local, 'state', None)
+
+    def forget(self, keys):
+        " drop the values of `keys` read within the current scope "
+        state = self.current()
+        if state is not None:
+            for k in keys:
+                state.memo.pop(k, None)
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, *exc_info):
+        self.end()
+
+
+def ensure_started(owner, target, name, workers=1):
+    """ start `workers` daemon threads running `target(pid)`, unless
+        `owner.pid` says they were started by this process already: threads
+        do not survive fork, so each process starts its own. Returns the
+        threads started. """
+    pid = os.getpid()
+    if owner.pid == pid:
+        return []
+    owner.pid = pid
+    threads = []
+    for i in range(workers):
+        if workers > 1:
+            name_i = '%s-%d' % (name, i)
+        else:
+            name_i = name
+        t = threading.Thread(target=target, args=(pid,), name=name_i)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    return threads
+
+
+class BatchQueue(object):
+    """ hand queued items to `handler` in batches from a background thread
+
+        `put(key, value)` queues an item; items of the same key are merged,
+        the last value wins. A thread calls `handler(items)` with dicts of at
+        most `batch_size` items, after waiting `interval` seconds for more
+        items to come. At most `maxsize` keys wait: `put` then blocks with
+        `block`, or returns False, and the caller decides what to do.
+        Items of failed batches are queued again up to `retries` times.
+
+        `stats` counts the items queued, merged, dropped, handled and
+        failed, and lag() is the age of the oldest waiting item. `key in
+        queue` tells whether an item of key waits or is being handled.
+
+        A forked process starts with an empty queue of its own: the items
+        of the parent are left to the parent. Once stop() is called, the
+        thread ends after handling the waiting items, and `put` returns
+        False.
+    """
+
+    def __init__(self, handler, maxsize=10000, batch_size=500, interval=0,
+                 retries=0, name='mc-batch-queue'):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.name = name
+        self.cond = threading.Condition()
+        self.pending = {}       # key -> (value, tries)
+        self.handling = {}      # the items taken by the thread
+        self.since = None       # when the oldest pending item was queued
+        self.busy = False
+        self.stopped = False
+        self.threads = []
+        self.pid = None
+        self.stats = dict(queued=0, merged=0, dropped=0, handled=0,
+                          failed=0)
+
+    def _forked(self):
+        if self.pid is None or self.pid == os.getpid():
+            return
+        # a thread of the parent may have held cond, or been handling items
+        self.pid = None
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.handling = {}
+        self.since = None
+        self.busy = False
+        self.threads = []
+
+    def _start(self):
+        threads = ensure_started(self, self._run, self.name)
+        if threads:
+            self.threads = threads
+
+    def put(self, key, value=None, block=False):
+        self._forked()
+        with self.cond:
+            if key in self.pending and not self.stopped:
+                self.pending[key] = (value, 0)
+                self.stats['merged'] += 1
+                return True
+            while self.stopped or len(self.pending) >= self.maxsize:
+                if self.stopped or not block:
+                    self.stats['dropped'] += 1
+                    return False
+                self.cond.wait()
+            if not self.pending:
+                self.since = time.time()
+            self.pending[key] = (value, 0)
+            self.stats['queued'] += 1
+            self._start()
+            self.cond.notify_all()
+            return True
+
+    def discard(self, key):
+        " forget the waiting item of key, e.g. when it is overwritten "
+        self._forked()
+        with self.cond:
+            if self.pending.pop(key, None) is not None:
+                self.cond.notify_all()
+
+    def __contains__(self, key):
+        self._forked()
+        return key in self.pending or key in self.handling
+
+    def lag(self):
+        self._forked()
+        since = self.since
+        return time.time() - since if since is not None else 0
+
+    def flush(self):
+        " wait until every queued item has been handled "
+        self._forked()
+        with self.cond:
+            if self.pending:
+                self._start()
+            while self.pending or self.busy:
+                self.cond.wait()
+
+    def stop(self, timeout=None):
+        """ end the thread once the waiting items are handled, waiting for
+            it `timeout` seconds at most; returns whether it has ended """
+        self._forked()
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+            threads = self.threads if self.pid == os.getpid() else []
+        for t in threads:
+            t.join(timeout)
+        return not any(t.is_alive() for t in threads)
+
+    def _take(self):
+        with self.cond:
+            while not self.pending:
+                if self.stopped:
+                    return None
+                self.cond.wait()
+            self.busy = True
+        if self.interval:
+            time.sleep(self.interval)
+        with self.cond:
+            pending, self.pending = self.pending, {}
+            self.handling = pending
+            self.since = None
+            self.cond.notify_all()
+            return pending
+
+    def _run(self, pid):
+        while True:
+            pending = self._take()
+            if pending is None:
+                return
+            keys = pending.keys()
+            for i in xrange(0, len(keys), self.batch_size):
+                batch = dict((k, pending[k][0])
+                             for k in keys[i:i + self.batch_size])
+                try:
+                    self.handler(batch)
+                except Exception:
+                    print >> sys.stderr, '%s: handler failed' % self.name
+                    traceback.print_exc()
+                    self._retry(batch, pending)
+                else:
+                    with self.cond:
+                        self.stats['handled'] += len(batch)
+            with self.cond:
+                self.busy = False
+                self.handling = {}
+                self.cond.notify_all()
+
+    def _retry(self, batch, pending):
+        with self.cond:
+            for k in batch:
+                value, tries = pending[k]
+                if tries < self.retries and k not in self.pending and \
+                        len(self.pending) < self.maxsize:
+                    if not self.pending:
+                        self.since = time.time()
+                    self.pending[k] = (value, tries + 1)
+                else:
+                    self.stats['failed'] += 1
+
+
+class CuckooFilter(object):
+    """ a compact approximate set of keys which supports removal
+
+        Keys are kept as 16 bit fingerprints in buckets of 4, about 2 bytes
+        per key for `capacity` keys. `key in f` may be wrongly True for
+        about 1 key in 8000, but is never wrongly False for a key added and
+        not discarded since. Discarding a key never added may drop another
+        key with the same fingerprint, check `key in f` before.
+
+        Once more keys are added than fit, it gives up and answers True
+        for every key, see `overflowed`.
+    """
+
+    BUCKET_SIZE = 4
+    MAX_KICKS = 500
+
+    def __init__(self, capacity):
+        buckets = 1
+        while buckets * self.BUCKET_SIZE * 0.9 < capacity:
+            buckets <<= 1
+        self.mask = buckets - 1
+        self.slots = array('H', [0]) * (buckets * self.BUCKET_SIZE)
+        self.count = 0
+        self.overflowed = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_keys(cls, keys, capacity):
+        f = cls(capacity)
+        for k in keys:
+            f.add(k)
+        return f
+
+    def _locate(self, key):
+        a, b = struct.unpack('<QQ', md5(key).digest())
+        fp = b & 0xffff or 1
+        i = a & self.mask
+        return fp, i, self._alt(i, fp)
+
+    def _alt(self, i, fp):
+        return (i ^ (fp * 0x5bd1e995)) & self.mask
+
+    def _bucket(self, i):
+        start = i * self.BUCKET_SIZE
+        return self.slots[start:start + self.BUCKET_SIZE]
+
+    def _insert(self, i, fp):
+        start = i * self.BUCKET_SIZE
+        slots = self.slots
+        for j in xrange(start, start + self.BUCKET_SIZE):
+            if not slots[j]:
+                slots[j] = fp
+                return True
+        return False
+
+    def __contains__(self, key):
+        if self.overflowed:
+            return True
+        fp, i1, i2 = self._locate(key)
+        return fp in self._bucket(i1) or fp in self._bucket(i2)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key):
+        fp, i1, i2 = self._locate(key)
+        with self.lock:
+            if self._insert(i1, fp) or self._insert(i2, fp):
+                self.count += 1
+                return
+            i = (i1, i2)[randrange(2)]
+            for n in xrange(self.MAX_KICKS):
+                j = i * self.BUCKET_SIZE + randrange(self.BUCKET_SIZE)
+                fp, self.slots[j] = self.slots[j], fp
+                i = self._alt(i, fp)
+                if self._insert(i, fp):
+                    self.count += 1
+                    return
+            # the fingerprint kicked out last has nowhere to go
+            self.overflowed = True
+
+    def discard(self, key):
+        fp, i1, i2 = self._locate(key)
+        slots = self.slots
+        with self.lock:
+            for i in (i1, i2):
+                start = i * self.BUCKET_SIZE
+                for j in xrange(start, start + self.BUCKET_SIZE):
+                    if slots[j] == fp:
+                        slots[j] = 0
+                        self.count -= 1
+                        return
+
+
+class HeavyHitters(object):
+    """ approximate counts of keys in a Count-Min sketch of `depth` rows of
+        `width` counters, and the `top` keys counted most so far
+
+        Counts are never under estimated, and over estimated by about
+        e / `width` of the total count for 1 - e ** -`depth` of the keys.
+        decay() halves every count, so that old reads fade out.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, width=4096, depth=4, top=100):
+        self.width = width
+        self.rows = [array('L', [0]) * width for i in range(depth)]
+        self.seeds = [(randrange(1, self._PRIME), randrange(self._PRIME))
+                      for i in range(depth)]
+        self.size = top
+        self.top = {}       # key -> count
+        self.floor = 0      # the least count in top once it is full
+
+    def _slots(self, key):
+        h = hash(key)
+        p, w = self._PRIME, self.width
+        return [(a * h + b) % p % w for a, b in self.seeds]
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self._slots(key)))
+
+    def add(self, key, n=1):
+        " count `n` reads of key, returns its estimated count "
+        slots = self._slots(key)
+        rows = self.rows
+        count = min(row[i] for row, i in zip(rows, slots)) + n
+        # conservative update: only raise the counters under the new count
+        for row, i in zip(rows, slots):
+            if row[i] < count:
+                row[i] = count
+        top = self.top
+        if key in top:
+            old, top[key] = top[key], count
+            if old == self.floor and len(top) == self.size:
+                # the least count may have risen
+                self.floor = min(top.itervalues())
+        elif len(top) < self.size:
+            top[key] = count
+            if len(top) == self.size:
+                self.floor = min(top.itervalues())
+        elif count > self.floor:
+            del top[min(top, key=top.get)]
+            top[key] = count
+            self.floor = min(top.itervalues())
+        return count
+
+    def decay(self):
+        self.rows = [array('L', (c >> 1 for c in row)) for row in self.rows]
+        self.top = dict((k, c >> 1) for k, c in self.top.iteritems() if c > 1)
+        self.floor = min(self.top.itervalues()) \
+                if len(self.top) == self.size else 0
+
+    def top_keys(self):
+        " [(key, count)] of the top keys, the most counted first "
+        return sorted(self.top.iteritems(), key=itemgetter(1), reverse=True)
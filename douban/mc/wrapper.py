@@ -1,35 +1,197 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import time
+import threading
 from random import randint
 from hashlib import md5
+from operator import attrgetter, itemgetter
+from itertools import islice
+from collections import deque
 
 import cmemcached
 
-from .util import LogMixin
+from .util import LogMixin, BatchQueue, HeavyHitters
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+def fingerprint(data):
+    """ a 64 bit fingerprint of serialized data, by xxhash when installed
+        (the `xxhash` extra), else by the first half of md5, slower
+
+        Both are well spread 64 bit hashes: two values sharing a
+        fingerprint, and so a version, take about 2**32 versions of one
+        key. Processes with and without xxhash disagree on versions, which
+        only costs a refetch of the value.
+    """
+    if xxhash is not None:
+        return xxhash.xxh64(data).hexdigest()
+    return md5(data).hexdigest()[:16]
+
+KEY_WRITERS = ('add', 'replace', 'delete', 'incr', 'decr', 'prepend',
+               'append', 'touch', 'expire', 'set_raw')
+MULTI_WRITERS = ('append_multi', 'prepend_multi', 'delete_multi',
+                 'set_multi')
+
+def _key_writer(name, target):
+    method = attrgetter('%s.%s' % (target, name))
+    def func(self, key, *args, **kwargs):
+        self._written(key)
+        return method(self)(key, *args, **kwargs)
+    func.__name__ = name
+    return func
+
+def _multi_writer(name, target):
+    method = attrgetter('%s.%s' % (target, name))
+    def func(self, keys, *args, **kwargs):
+        self._written_multi(keys)
+        return method(self)(keys, *args, **kwargs)
+    func.__name__ = name
+    return func
+
+def forward_writers(target, key_writers=KEY_WRITERS,
+                    multi_writers=MULTI_WRITERS):
+    """ class decorator defining the writers a wrapper does not define
+        itself, calling self._written(key) or self._written_multi(keys)
+        and then the same method of the client in attribute `target`.
+
+        They are made once here, instead of a closure per call by
+        __getattr__.
+    """
+    def decorate(cls):
+        for name in key_writers:
+            if name not in cls.__dict__:
+                setattr(cls, name, _key_writer(name, target))
+        for name in multi_writers:
+            if name not in cls.__dict__:
+                setattr(cls, name, _multi_writer(name, target))
+        return cls
+    return decorate
+
+@forward_writers('_newmc', KEY_WRITERS + ('set', 'cas'))
 class AdjustMC(object):
-    def __init__(self, oldmc, newmc):
+    """ migrate keys from oldmc to newmc lazily
+
+        Whether a key is routed to another server by newmc is remembered
+        for up to `route_cache_size` keys, so hot keys skip the routing of
+        both clients.
+
+        Values found on oldmc are moved with one set_multi and one
+        delete_multi per batch. With `migrators`, a pair of old and new
+        clients owned by a background BatchQueue, they are moved from its
+        thread instead of the reading one: clients are not shared between
+        threads.
+
+        `old_keys` is an optional set of the keys left on oldmc, such as a
+        CuckooFilter built from a key dump once every writer goes through
+        AdjustMC. Keys are discarded from it when their values are moved
+        off oldmc, and oldmc is not asked for keys it does not contain.
+    """
+    __slots__ = ('_oldmc', '_newmc', '_old_keys', '_moved',
+                 '_route_cache_size', '_migrators', '_migrate_queue')
+
+    def __init__(self, oldmc, newmc, route_cache_size=100000,
+                 migrators=None, old_keys=None):
         self._oldmc = oldmc
         self._newmc = newmc
+        self._old_keys = old_keys
+        self._moved = {}
+        self._route_cache_size = route_cache_size
+        self._migrators = migrators
+        self._migrate_queue = None
+        if migrators is not None:
+            self._migrate_queue = BatchQueue(self._migrate_in_background,
+                                             name='mc-adjust-migrate')
+
+    def _migrate(self, values, oldmc=None, newmc=None):
+        (newmc or self._newmc).set_multi(values, 3600 + randint(0, 3600))
+        (oldmc or self._oldmc).delete_multi(values.keys())
+        self.forget(values)
+
+    def _migrate_in_background(self, values):
+        self._migrate(values, *self._migrators)
+
+    @property
+    def oldmc(self):
+        return self._oldmc
+
+    @property
+    def newmc(self):
+        return self._newmc
+
+    def forget(self, keys):
+        " the values of `keys` were moved off oldmc "
+        # only keys found on oldmc: discarding a key which was not in the
+        # dump may drop another one with the same fingerprint
+        if self._old_keys is not None:
+            for k in keys:
+                self._old_keys.discard(k)
+
+    def left_on_old(self, keys):
+        " the keys of `keys` oldmc may still hold, by old_keys "
+        if self._old_keys is None:
+            return keys
+        return [k for k in keys if k in self._old_keys]
+
+    def _migrated(self, values):
+        if self._migrate_queue is None:
+            return self._migrate(values)
+        for k, v in values.iteritems():
+            self._migrate_queue.put(k, v)
+
+    def _overwritten(self, keys):
+        if self._migrate_queue is not None:
+            for k in keys:
+                self._migrate_queue.discard(k)
 
     def moved(self, key):
-        return self._oldmc.get_host_by_key(key) != self._newmc.get_host_by_key(key)
+        r = self._moved.get(key)
+        if r is None:
+            r = self._oldmc.get_host_by_key(key) != self._newmc.get_host_by_key(key)
+            if len(self._moved) >= self._route_cache_size:
+                self._moved.clear()
+            self._moved[key] = r
+        return r
+
+    def moved_keys(self, keys):
+        " the keys of `keys` routed to another server by newmc "
+        moved = self._moved
+        if len(moved) + len(keys) > self._route_cache_size:
+            moved.clear()
+        old_host = self._oldmc.get_host_by_key
+        new_host = self._newmc.get_host_by_key
+        r = []
+        for k in keys:
+            m = moved.get(k)
+            if m is None:
+                m = moved[k] = old_host(k) != new_host(k)
+            if m:
+                r.append(k)
+        return r
 
     def get(self, key):
         v = self._newmc.get(key)
-        if v is None and self.moved(key):
+        if v is None and self.moved(key) and self.left_on_old([key]):
             v = self._oldmc.get(key)
             if v is not None:
-                self._newmc.set(key, v, 3600 + randint(0, 3600))
-                self._oldmc.delete(key)
+                if self._migrate_queue is None:
+                    self._newmc.set(key, v, 3600 + randint(0, 3600))
+                    self._oldmc.delete(key)
+                    self.forget([key])
+                else:
+                    self._migrate_queue.put(key, v)
         return v
 
     def get_multi(self, keys):
         r = self._newmc.get_multi(keys)
-        rs = self._oldmc.get_multi([k for k in keys if k not in r and self.moved(k)])
-        for k,v in rs.iteritems():
-            self._newmc.set(k, v, 3600 + randint(0, 3600))
-            self._oldmc.delete(k)
+        moved_keys = self.left_on_old(
+            self.moved_keys([k for k in keys if k not in r]))
+        rs = self._oldmc.get_multi(moved_keys) if moved_keys else {}
+        if rs:
+            self._migrated(rs)
         r.update(rs)
         return r
 
@@ -40,7 +202,15 @@ class AdjustMC(object):
     def clear(self):
         pass
 
+    def stop(self, timeout=5):
+        " end the background migration, leaving oldmc and newmc open "
+        if self._migrate_queue is not None and \
+                self._migrate_queue.stop(timeout):
+            for client in self._migrators:
+                client.close()
+
     def close(self):
+        self.stop()
         self._oldmc.close()
         self._newmc.close()
 
@@ -52,49 +222,147 @@ class AdjustMC(object):
         self._oldmc.clear_thread_ident()
         self._newmc.clear_thread_ident()
 
+    def _written(self, key):
+        if self.moved(key):
+            self._overwritten([key])
+            self._oldmc.delete(key)
+
+    def _written_multi(self, keys):
+        moved_keys = self.moved_keys(keys)
+        self._overwritten(moved_keys)
+        self._oldmc.delete_multi(moved_keys)
+
     def __getattr__(self, name):
-        if name in ('add','replace','set','cas','delete','incr','decr',
-                    'prepend','append','touch','expire'):
-            def func(key, *args, **kwargs):
-                if self.moved(key):
-                    self._oldmc.delete(key)
-                return getattr(self._newmc, name)(key, *args, **kwargs)
-            return func
-        elif name in ('append_multi', 'prepend_multi', 'delete_multi',
-                      'set_multi'):
-            def func(keys, *args, **kwargs):
-                moved_keys = [k for k in keys if self.moved(k)]
-                self._oldmc.delete_multi(moved_keys)
-                return  getattr(self._newmc, name)(keys, *args, **kwargs)
-            return func
-        elif not name.startswith('__'):
-            def func(*args, **kwargs):
-                return getattr(self.mc, name)(*args, **kwargs)
-            return func
+        if not name.startswith('__'):
+            return getattr(self._newmc, name)
         raise AttributeError(name)
 
+_raw = object()
+
+@forward_writers('mc')
 class Replicated(LogMixin):
-    "replacated memcached for fail-over"
-    def __init__(self, master, rep):
+    """replacated memcached for fail-over
+
+    Values only found on rep are written back to master with one set_multi
+    per batch. With a `repair_writer` client of master, they are written
+    back through it by a background BatchQueue instead of the reading
+    thread.
+
+    With a HedgedReader as `hedge`, reads go to rep as well when master is
+    slower than usual; values won by rep are not written back to master.
+    get_multi merges the answers of both.
+
+    With a `replica_writer` client, writes to rep are queued and done by a
+    background thread through it, coalesced into set_multi/delete_multi
+    batches (set_raw is written key by key), and rep is not read for a key
+    until its write is done. When the queue is full, `replica_overflow` is
+    'delete' to delete the key from rep inline instead, or 'block' to wait.
+    """
+    __slots__ = ('mc', 'rep', 'hedge', 'replica_writer', 'replica_overflow',
+                 'replica_queue', 'repair_writer', 'repair_queue')
+
+    def __init__(self, master, rep, repair_writer=None, hedge=None,
+                 replica_writer=None, replica_overflow='delete'):
         self.mc = master
         self.rep = rep
+        self.hedge = hedge
+        self.replica_writer = replica_writer
+        self.replica_overflow = replica_overflow
+        self.replica_queue = None
+        if replica_writer is not None:
+            self.replica_queue = BatchQueue(self._write_replica, retries=1,
+                                            name='mc-replicated-write')
+        self.repair_writer = repair_writer
+        self.repair_queue = None
+        if repair_writer is not None:
+            self.repair_queue = BatchQueue(self._repair,
+                                           name='mc-replicated-repair')
 
     def __repr__(self):
         return "replicated " + str(self.mc)
 
+    def _repair(self, values):
+        self.repair_writer.set_multi(values, 60 * 10)
+
+    def _repaired(self, values):
+        if self.repair_queue is None:
+            return self.mc.set_multi(values, 60 * 10)
+        for k, v in values.iteritems():
+            self.repair_queue.put(k, v)
+
+    def _overwritten(self, keys):
+        if self.repair_queue is not None:
+            for k in keys:
+                self.repair_queue.discard(k)
+
+    def _write_replica(self, items):
+        deletes = []
+        sets = {}
+        for k, item in items.iteritems():
+            if item is None:
+                deletes.append(k)
+            elif item[0] is _raw:
+                _, data, time, flag = item
+                self.replica_writer.set_raw(k, data, time, flag)
+            else:
+                value, time, compress = item
+                sets.setdefault((time, compress), {})[k] = value
+        if deletes:
+            self.replica_writer.delete_multi(deletes)
+        for (time, compress), values in sets.iteritems():
+            self.replica_writer.set_multi(values, time, compress)
+
+    def _replicate(self, key, item):
+        block = self.replica_overflow == 'block'
+        if not self.replica_queue.put(key, item, block=block):
+            self.rep.delete(key)
+
+    def _invalidate(self, keys):
+        if self.replica_queue is None:
+            return self.rep.delete_multi(keys)
+        for k in keys:
+            self._replicate(k, None)
+
+    def _queued(self, keys):
+        " the keys of `keys` whose writes to rep are not done yet "
+        queue = self.replica_queue
+        if queue is None:
+            return ()
+        return set(k for k in keys if k in queue)
+
+    def _read(self, name, arg, multi=False, may_hedge=True):
+        if may_hedge and self.hedge is not None:
+            if multi:
+                r = self.hedge.read_multi(name, arg)
+            else:
+                r = self.hedge.read(name, arg)
+            if r is not None:
+                return r
+        return getattr(self.mc, name)(arg), False
+
     def get(self, key):
-        v = self.mc.get(key)
-        if v is None:
+        # rep holds an old value of a key until its queued write is done
+        queued = self._queued([key])
+        v, rep_asked = self._read('get', key, may_hedge=not queued)
+        if v is None and not rep_asked and not queued:
             v = self.rep.get(key)
             if v is not None:
-                self.mc.set(key, v, 60 * 10)
+                if self.repair_queue is None:
+                    self.mc.set(key, v, 60 * 10)
+                else:
+                    self.repair_queue.put(key, v)
         return v
 
     def get_multi(self, keys):
-        r = self.mc.get_multi(keys)
-        rs = self.rep.get_multi([k for k in keys if k not in r])
-        for k,v in rs.items():
-            self.mc.set(k, v, 60 * 10)
+        queued = self._queued(keys)
+        r, rep_asked = self._read('get_multi', keys, multi=True,
+                                  may_hedge=not queued)
+        if rep_asked:
+            return r
+        rs = self.rep.get_multi([k for k in keys
+                                 if k not in r and k not in queued])
+        if rs:
+            self._repaired(rs)
         r.update(rs)
         return r
 
@@ -105,14 +373,39 @@ class Replicated(LogMixin):
     def set(self, key, value, time=0, compress=True):
         if value is None:
             return
+        self._overwritten([key])
         # let key expire in rep first
-        self.rep.set(key, value, time/2, compress)
+        if self.replica_queue is None:
+            self.rep.set(key, value, time/2, compress)
+        else:
+            self._replicate(key, (value, time/2, compress))
         return self.mc.set(key, value, time, compress)
 
+    def set_raw(self, key, data, time=0, flag=0):
+        self._overwritten([key])
+        if self.replica_queue is None:
+            self.rep.set_raw(key, data, time/2, flag)
+        else:
+            self._replicate(key, (_raw, data, time/2, flag))
+        return self.mc.set_raw(key, data, time, flag)
+
     def clear(self):
         pass
 
+    def stop(self, timeout=5):
+        """ end the background reads and writes and close their clients,
+            leaving master and rep open """
+        if self.hedge is not None:
+            self.hedge.stop(timeout)
+        for queue, writer in ((self.replica_queue, self.replica_writer),
+                              (self.repair_queue, self.repair_writer)):
+            if queue is not None and queue.stop(timeout):
+                writer.close()
+        if hasattr(self.mc, 'stop'):
+            self.mc.stop(timeout)
+
     def close(self):
+        self.stop()
         self.mc.close()
         self.rep.close()
 
@@ -124,66 +417,218 @@ class Replicated(LogMixin):
         self.mc.clear_thread_ident()
         self.rep.clear_thread_ident()
 
+    def _written(self, key):
+        if self.repair_queue is not None:
+            self.repair_queue.discard(key)
+        if self.replica_queue is None:
+            self.rep.delete(key)
+        else:
+            self._replicate(key, None)
+
+    def _written_multi(self, keys):
+        self._overwritten(keys)
+        self._invalidate(keys)
+
     def __getattr__(self, name):
-        if name in ('add','replace','delete','incr','decr',
-                    'prepend','append','touch','expire'):
-            def func(key, *args, **kwargs):
-                self.rep.delete(key)
-                return getattr(self.mc, name)(key, *args, **kwargs)
-            return func
-        elif name in ('append_multi', 'prepend_multi', 'delete_multi',
-                      'set_multi'):
-            def func(keys, *args, **kwargs):
-                self.rep.delete_multi(keys)
-                return getattr(self.mc, name)(keys, *args, **kwargs)
-            return func
-        elif not name.startswith('__'):
-            def func(*args, **kwargs):
-                return getattr(self.mc, name)(*args, **kwargs)
-            return func
+        if not name.startswith('__'):
+            return getattr(self.mc, name)
         raise AttributeError(name)
 
 
+_missing = object()
+PREV, NEXT, KEY, VALUE, EXPIRES, SIZE = range(6)
+ENTRY_OVERHEAD = 200 # dict slot, node list and key object, roughly
+
+def estimate_size(value, depth=3, sample=16):
+    """ bytes taken by value, estimated by sys.getsizeof down to `depth`
+        levels of containers and objects; the items of a container are
+        estimated from its first `sample` ones """
+    if isinstance(value, str):
+        return len(value)
+    size = sys.getsizeof(value, 64)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        items = list(islice(value.iteritems(), sample))
+        n = sum(estimate_size(k, depth - 1, sample) +
+                estimate_size(v, depth - 1, sample) for k, v in items)
+    elif isinstance(value, (list, tuple, set, frozenset, deque)):
+        items = list(islice(value, sample))
+        n = sum(estimate_size(v, depth - 1, sample) for v in items)
+    elif hasattr(value, '__dict__'):
+        return size + estimate_size(value.__dict__, depth - 1, sample)
+    else:
+        return size
+    if len(items) < len(value):
+        n = n * len(value) // len(items)
+    return size + n
+
+@forward_writers('mc')
 class LocalCached(LogMixin):
-    " cache obj in local process, wrapper for memcache "
-    def __init__(self, mc_client, size=10000):
+    """ cache obj in local process, wrapper for memcache
+
+        At most `size` objs are kept, the least recently used is evicted
+        first. With `ttl`, objs are also dropped `ttl` seconds after cached.
+        With `max_bytes`, the estimated bytes of the cached objs (by
+        `size_of`, estimate_size by default) are kept under it too, see
+        usage().
+
+        With `negative_ttl`, keys found absent in mc by get, get_multi and
+        get_list are remembered for `negative_ttl` seconds, at most
+        `negative_size` of them, and are not asked for again meanwhile.
+
+        `dataset` maps keys to the nodes of a circular doubly linked list
+        ordered by recency, [PREV, NEXT, KEY, VALUE, EXPIRES, SIZE].
+    """
+    __slots__ = ('dataset', 'root', 'lock', 'mc', 'size', 'ttl', 'max_bytes',
+                 'size_of', 'bytes', 'negative_ttl', 'negative_size',
+                 'negative', 'negative_order', 'stats')
+
+    def __init__(self, mc_client, size=10000, ttl=0, max_bytes=0,
+                 size_of=estimate_size, negative_ttl=0, negative_size=1000):
         self.dataset = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0, 0]
+        self.lock = threading.Lock()
         self.mc = mc_client
         self.size = size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.bytes = 0
+        self.negative_ttl = negative_ttl
+        self.negative_size = negative_size
+        self.negative = {}
+        self.negative_order = deque()
+        self.stats = dict(hits=0, misses=0, evictions=0, negative_hits=0)
+
+    def usage(self):
+        return dict(entries=len(self.dataset), bytes=self.bytes)
 
     def clear(self):
-        self.dataset.clear()
+        with self.lock:
+            self.dataset.clear()
+            self.root[:] = [self.root, self.root, None, None, 0, 0]
+            self.bytes = 0
+            self.negative.clear()
+            self.negative_order.clear()
         if hasattr(self.mc, 'clear'):
             self.mc.clear()
 
+    def _lookup(self, key):
+        with self.lock:
+            node = self.dataset.get(key)
+            if node is None or self.ttl and node[EXPIRES] <= time.time():
+                if node is not None:
+                    self._unlink(node)
+                elif key in self.negative:
+                    if self.negative[key] > time.time():
+                        self.stats['negative_hits'] += 1
+                        return None
+                    del self.negative[key]
+                self.stats['misses'] += 1
+                return _missing
+            self.stats['hits'] += 1
+            # move to the most recent end
+            root = self.root
+            node[PREV][NEXT] = node[NEXT]
+            node[NEXT][PREV] = node[PREV]
+            last = root[PREV]
+            last[NEXT] = root[PREV] = node
+            node[PREV] = last
+            node[NEXT] = root
+            return node[VALUE]
+
+    def _unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+        del self.dataset[node[KEY]]
+        self.bytes -= node[SIZE]
+
+    def _remember_absent(self, keys):
+        if not self.negative_ttl or not keys:
+            return
+        now = time.time()
+        expires = now + self.negative_ttl
+        negative = self.negative
+        order = self.negative_order
+        with self.lock:
+            for k in keys:
+                negative[k] = expires
+                order.append((k, expires))
+            # entries are ordered by expiration, as they share one ttl
+            while order and (len(negative) > self.negative_size or
+                             order[0][1] <= now):
+                k, e = order.popleft()
+                if negative.get(k) == e:
+                    del negative[k]
+
     def _cache(self, key, value):
-        if len(self.dataset) >= self.size:
-            self.dataset.clear()
-        self.dataset[key] = value
+        ds = self.dataset
+        root = self.root
+        expires = self.ttl and time.time() + self.ttl
+        size = 0
+        if self.max_bytes:
+            size = self.size_of(value) + len(key) + ENTRY_OVERHEAD
+            if size > self.max_bytes:
+                self._drop(key)
+                return
+        with self.lock:
+            self.negative.pop(key, None)
+            node = ds.get(key)
+            if node is not None:
+                self._unlink(node)
+            while ds and (len(ds) >= self.size or
+                          self.max_bytes and
+                          self.bytes + size > self.max_bytes):
+                self._unlink(root[NEXT])
+                self.stats['evictions'] += 1
+            last = root[PREV]
+            node = [last, root, key, value, expires, size]
+            last[NEXT] = root[PREV] = ds[key] = node
+            self.bytes += size
+
+    def _drop(self, key):
+        with self.lock:
+            self.negative.pop(key, None)
+            node = self.dataset.get(key)
+            if node is not None:
+                self._unlink(node)
+
+    _written = _drop
 
     def __repr__(self):
         return "Locally Cached " + str(self.mc)
 
     def get(self, key):
-        if key in self.dataset:
-            return self.dataset[key]
+        r = self._lookup(key)
+        if r is not _missing:
+            return r
         r = self.mc.get(key)
         if r is not None:
             self._cache(key, r)
+        else:
+            self._remember_absent([key])
         return r
 
     def gets(self, key):
         return self.mc.gets(key)
 
     def get_multi(self, keys):
-        ds = self.dataset
-        ds_get = ds.get
-        r = dict((k, ds[k]) for k in keys if ds_get(k) is not None)
-        missed = [k for k in keys if k not in ds]
+        r = {}
+        missed = []
+        for k in keys:
+            v = self._lookup(k)
+            if v is _missing:
+                missed.append(k)
+            elif v is not None:
+                r[k] = v
         if missed:
             rs = self.mc.get_multi(missed)
             r.update(rs)
-            ds.update(dict((k, rs.get(k)) for k in missed))
+            for k, v in rs.iteritems():
+                self._cache(k, v)
+            self._remember_absent([k for k in missed if k not in rs])
         return r
 
     def get_list(self, keys):
@@ -199,35 +644,321 @@ class LocalCached(LogMixin):
             self._cache(key, value)
             return True
         else:
-            self.dataset.pop(key, None) # FIXME
+            self._drop(key) # FIXME
             return False
 
+    def _written_multi(self, keys):
+        for k in keys:
+            self._drop(k)
+
     def __getattr__(self, name):
-        if name in ('add','replace','delete','incr','decr',
-                    'prepend','append','touch','expire'):
-            def func(key, *args, **kwargs):
-                self.dataset.pop(key, None)
-                return getattr(self.mc, name)(key, *args, **kwargs)
-            return func
-        elif name in ('append_multi', 'prepend_multi', 'delete_multi', 'set_multi'):
-            def func(keys, *args, **kwargs):
-                for k in keys:
-                    self.dataset.pop(k, None)
-                return getattr(self.mc, name)(keys, *args, **kwargs)
-            return func
-        elif not name.startswith('__'):
-            def func(*args, **kwargs):
-                return getattr(self.mc, name)(*args, **kwargs)
-            return func
+        if not name.startswith('__'):
+            return getattr(self.mc, name)
         raise AttributeError(name)
 
     def reset(self):
         self.mc.reset()
         self.clear()
 
+@forward_writers('mc')
+class SharedLocalCached(LogMixin):
+    """ cache obj in a segment shared by the processes of a host, wrapper
+        for memcache
+
+        Every process opening the same `path` (e.g. the prefork workers of
+        a server) sees the same objs, see shm.SharedSegment for `size` and
+        the other options. Objs are dropped `ttl` seconds after cached, or
+        when they expire in mc if sooner: writes from other hosts are seen
+        after `ttl` seconds at most.
+
+        The segment outlives clear() and reset(), which only reach the
+        wrapped client; wipe() empties it for every process of the host.
+        A process should wrap one client per `path`, see SharedSegment.
+    """
+    __slots__ = ('mc', 'ttl', 'segment')
+
+    def __init__(self, mc_client, path, size=64 << 20, ttl=1, **kwargs):
+        from .shm import SharedSegment
+        if not ttl > 0:
+            raise ValueError('ttl must be positive, objs would never expire')
+        self.mc = mc_client
+        self.ttl = ttl
+        self.segment = SharedSegment(path, size, **kwargs)
+
+    def _ttl(self, expire):
+        # a unix time given to mc is always later than ttl
+        return min(expire, self.ttl) if expire else self.ttl
+
+    def __repr__(self):
+        return "Shared Locally Cached " + str(self.mc)
+
+    def clear(self):
+        if hasattr(self.mc, 'clear'):
+            self.mc.clear()
+
+    def wipe(self):
+        self.segment.wipe()
+
+    def close(self):
+        self.segment.close()
+        self.mc.close()
+
+    def get(self, key):
+        r = self.segment.get(key)
+        if r is not None:
+            return r
+        r = self.mc.get(key)
+        if r is not None:
+            self.segment.set(key, r, self.ttl)
+        return r
+
+    def gets(self, key):
+        return self.mc.gets(key)
+
+    def get_multi(self, keys):
+        r = {}
+        missed = []
+        for k in keys:
+            v = self.segment.get(k)
+            if v is None:
+                missed.append(k)
+            else:
+                r[k] = v
+        if missed:
+            rs = self.mc.get_multi(missed)
+            for k, v in rs.iteritems():
+                self.segment.set(k, v, self.ttl)
+            r.update(rs)
+        return r
+
+    def get_list(self, keys):
+        rs = self.get_multi(keys)
+        return [rs.get(k) for k in keys]
+
+    def set(self, key, value, time=0, compress=True):
+        if value is None:
+            self.segment.delete(key)
+        else:
+            self.segment.set(key, value, self._ttl(time))
+        return self.mc.set(key, value, time, compress)
+
+    def cas(self, key, value, time=0, cas=0):
+        if self.mc.cas(key, value, time, cas):
+            self.segment.set(key, value, self._ttl(time))
+            return True
+        else:
+            self.segment.delete(key)
+            return False
+
+    def _written(self, key):
+        self.segment.delete(key)
+
+    def _written_multi(self, keys):
+        for k in keys:
+            self.segment.delete(k)
+
+    def __getattr__(self, name):
+        if not name.startswith('__'):
+            return getattr(self.mc, name)
+        raise AttributeError(name)
+
+    def reset(self):
+        self.mc.reset()
+        self.clear()
+
+@forward_writers('mc', KEY_WRITERS + ('cas',))
+class RequestCached(LogMixin):
+    " cache obj within the current request of a RequestScope, wrapper for memcache "
+    __slots__ = ('mc', 'scope')
+
+    def __init__(self, mc_client, scope):
+        self.mc = mc_client
+        self.scope = scope
+
+    def __repr__(self):
+        return "Request Cached " + str(self.mc)
+
+    def get(self, key):
+        state = self.scope.current()
+        if state is None:
+            return self.mc.get(key)
+        return state.get(key, self.mc.get)
+
+    def get_multi(self, keys):
+        state = self.scope.current()
+        if state is None:
+            return self.mc.get_multi(keys)
+        ds = state.memo
+        r = dict((k, ds[k]) for k in keys if k in ds)
+        missed = [k for k in keys if k not in ds]
+        if missed:
+            rs = self.mc.get_multi(missed)
+            r.update(rs)
+            ds.update(rs)
+        return r
+
+    def get_list(self, keys):
+        rs = self.get_multi(keys)
+        return [rs.get(k) for k in keys]
+
+    def set(self, key, value, time=0, compress=True):
+        # mc may drop key from the scope as well, see MCManager.add_scope
+        r = self.mc.set(key, value, time, compress)
+        state = self.scope.current()
+        if state is not None:
+            state.memo.pop(key, None)
+            if value is not None:
+                state.memo[key] = value
+        return r
+
+    def _written(self, key):
+        self.scope.forget([key])
+
+    def _written_multi(self, keys):
+        self.scope.forget(keys)
+
+    def __getattr__(self, name):
+        if not name.startswith('__'):
+            return getattr(self.mc, name)
+        raise AttributeError(name)
+
+@forward_writers('mc', KEY_WRITERS + ('set', 'cas'))
+class HotKeyCached(LogMixin):
+    """ cache the hottest keys of memcache in local process, wrapper for
+        memcache
+
+        One read in `sample` by get, get_multi and get_list is counted in a
+        HeavyHitters sketch of `top` keys. A key counted `threshold` times
+        is hot, and its value is cached for `ttl` seconds. Counts are halved
+        every `window` seconds; keys falling under half the threshold, or
+        out of the top keys, are cooled and not cached any more.
+
+        Writers through this wrapper drop the local value, but other
+        processes may read an old one for up to `ttl` seconds.
+        hot_keys() lists the hot keys and their counts.
+    """
+    __slots__ = ('mc', 'sketch', 'threshold', 'window', 'ttl', 'sample',
+                 'hot', 'cached', 'lock', 'reads', 'decayed', 'stats')
+
+    def __init__(self, mc_client, threshold=1000, window=10, ttl=1,
+                 sample=10, top=100):
+        self.mc = mc_client
+        self.sketch = HeavyHitters(top=top)
+        self.threshold = threshold
+        self.window = window
+        self.ttl = ttl
+        self.sample = sample
+        self.hot = set()
+        self.cached = {}        # key -> (value, expires)
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.decayed = time.time()
+        self.stats = dict(hits=0, promoted=0, demoted=0)
+
+    def __repr__(self):
+        return "Hot Key Cached " + str(self.mc)
+
+    def hot_keys(self):
+        " [(key, count)] of the hot keys, the hottest first "
+        with self.lock:
+            return sorted(((k, self.sketch.estimate(k)) for k in self.hot),
+                          key=itemgetter(1), reverse=True)
+
+    def _count(self, key):
+        self.reads += 1
+        if self.reads % self.sample:
+            return
+        with self.lock:
+            now = time.time()
+            if now - self.decayed >= self.window:
+                self._cool(now)
+            count = self.sketch.add(key, self.sample)
+            if count >= self.threshold and key not in self.hot and \
+                    key in self.sketch.top:
+                self.hot.add(key)
+                self.stats['promoted'] += 1
+
+    def _cool(self, now):
+        self.decayed = now
+        sketch = self.sketch
+        sketch.decay()
+        for k in list(self.hot):
+            if k not in sketch.top or sketch.top[k] < self.threshold / 2:
+                self.hot.discard(k)
+                self.cached.pop(k, None)
+                self.stats['demoted'] += 1
+
+    def _lookup(self, key):
+        r = self.cached.get(key)
+        if r is not None:
+            if r[1] > time.time():
+                self.stats['hits'] += 1
+                return r[0]
+            self.cached.pop(key, None)
+        return None
+
+    def _cache(self, key, value):
+        if value is not None and key in self.hot:
+            self.cached[key] = (value, time.time() + self.ttl)
+
+    def clear(self):
+        self.cached.clear()
+        if hasattr(self.mc, 'clear'):
+            self.mc.clear()
+
+    def get(self, key):
+        self._count(key)
+        r = self._lookup(key)
+        if r is None:
+            r = self.mc.get(key)
+            self._cache(key, r)
+        return r
+
+    def get_multi(self, keys):
+        r = {}
+        missed = []
+        for k in keys:
+            self._count(k)
+            v = self._lookup(k)
+            if v is None:
+                missed.append(k)
+            else:
+                r[k] = v
+        if missed:
+            rs = self.mc.get_multi(missed)
+            for k, v in rs.iteritems():
+                self._cache(k, v)
+            r.update(rs)
+        return r
+
+    def get_list(self, keys):
+        rs = self.get_multi(keys)
+        return [rs.get(k) for k in keys]
+
+    def _written(self, key):
+        self.cached.pop(key, None)
+
+    def _written_multi(self, keys):
+        for k in keys:
+            self.cached.pop(k, None)
+
+    def __getattr__(self, name):
+        if not name.startswith('__'):
+            return getattr(self.mc, name)
+        raise AttributeError(name)
+
 class VersionedLocalCached(object):
-    def __init__(self, _mc):
+    """ cache obj in local process, checking its version in mc on each get
+
+        With `raw`, values are stored with the client's set_raw, reusing
+        the bytes serialized for the version instead of serializing twice.
+        They are compressed beyond `comp_threshold` bytes, as by the clients
+        of create_mc, and their version is that of the compressed bytes.
+    """
+    def __init__(self, _mc, raw=False, comp_threshold=1024):
         self.mc = _mc
+        self.raw = raw
+        self.comp_threshold = comp_threshold
         self.dataset = {}
 
     def get(self, key):
@@ -244,33 +975,58 @@ class VersionedLocalCached(object):
 
     def add(self, key, value, time=0):
         self.dataset.pop(key, None)
-        ver = self._get_version(value)
+        serialized, flag = self._prepare(value)
+        ver = self._get_version(serialized)
         if self.mc.add(key+':VER2', ver, time):
-            self.mc.set(key+':V_'+ver, value, time)
+            self._set_value(key+':V_'+ver, value, serialized, flag, time)
             return 1
         return 0
 
     def set(self, key, value, time=0):
         if value is None:
             return
-        ver = self._get_version(value)
-        r = self.mc.set(key+':V_'+ver, value, time)
+        serialized, flag = self._prepare(value)
+        ver = self._get_version(serialized)
+        r = self._set_value(key+':V_'+ver, value, serialized, flag, time)
         self.mc.set(key+':VER2', ver, time)
         self.dataset[key] = (value, ver)
         return r
 
+    def _prepare(self, value):
+        # the bytes stored by set() are the client's business
+        threshold = self.comp_threshold if self.raw else 0
+        return cmemcached.prepare(value, threshold)
+
+    def _set_value(self, key, value, serialized, flag, time):
+        if self.raw:
+            return self.mc.set_raw(key, serialized, time, flag)
+        return self.mc.set(key, value, time)
+
     def get_multi(self, keys):
-        #TODO to optimize
+        # versions first, then the values whose cached version is stale
+        vers = self.mc.get_multi([key+':VER2' for key in keys])
         d = {}
+        stale = {}
         for key in keys:
-            val = self.get(key)
-            if val is not None:
+            ver = vers.get(key+':VER2')
+            if ver is None:
+                continue
+            val, cached_ver = self.dataset.get(key, (None, None))
+            if cached_ver == ver:
+                d[key] = val
+            else:
+                stale[key+':V_'+ver] = (key, ver)
+        if stale:
+            vals = self.mc.get_multi(stale.keys())
+            for vkey, val in vals.iteritems():
+                key, ver = stale[vkey]
+                self.dataset[key] = (val, ver)
                 d[key] = val
         return d
 
     def get_list(self, keys):
-        #TODO to optimize
-        return [self.get(k) for k in keys]
+        d = self.get_multi(keys)
+        return [d.get(k) for k in keys]
 
     def delete(self, key):
         self.dataset.pop(key, None)
@@ -283,18 +1039,47 @@ class VersionedLocalCached(object):
         self.dataset.pop(key, None)
         return self.mc.expire(key+':VER2')
 
-    def _get_version(self, value):
-        serialed, flag = cmemcached.prepare(value, 0)
-        return md5(serialed).hexdigest()
-
-    def _get_version(self, value):
-        serialized, flag = cmemcached.prepare(value, 0)
-        return md5(serialized).hexdigest()
+    def _get_version(self, serialized):
+        return fingerprint(serialized)
 
+@forward_writers('mc', KEY_WRITERS + ('set',))
 class SyncMC(object):
-    def __init__(self, main_mc, sync_mc):
+    """ invalidate keys on sync_mc, e.g. a cluster in another datacenter,
+        before writing them to main_mc
+
+        With `async_invalidate`, keys are deleted from sync_mc by a
+        background thread instead, deduplicated for `window` seconds and
+        deleted with one delete_multi per batch, retried `retries` times.
+        At most `maxsize` keys wait, writers block beyond that.
+    """
+    __slots__ = ('mc', 'sync_mc', 'invalidate_queue')
+
+    def __init__(self, main_mc, sync_mc, async_invalidate=False,
+                 window=0.05, maxsize=10000, retries=3):
         self.mc = main_mc
         self.sync_mc = sync_mc
+        self.invalidate_queue = None
+        if async_invalidate:
+            self.invalidate_queue = BatchQueue(
+                    self._delete_synced, maxsize=maxsize, interval=window,
+                    retries=retries, name='mc-sync-invalidate')
+
+    def _delete_synced(self, keys):
+        if not self.sync_mc.delete_multi(list(keys)):
+            raise IOError('delete_multi failed on %s' % self.sync_mc)
+
+    def invalidate(self, keys):
+        if self.invalidate_queue is None:
+            if len(keys) == 1:
+                return self.sync_mc.delete(keys[0])
+            return self.sync_mc.delete_multi(keys)
+        for k in keys:
+            self.invalidate_queue.put(k, block=True)
+
+    def flush(self):
+        " wait until the queued invalidations are done "
+        if self.invalidate_queue is not None:
+            self.invalidate_queue.flush()
 
     def clear_thread_ident(self):
         self.mc.clear_thread_ident()
@@ -304,12 +1089,14 @@ class SyncMC(object):
         self.mc.reset()
         self.sync_mc.reset()
 
-    def __getattr__(self, name):
-        if name in ('add', 'replace', 'set', 'delete','incr','decr',
-                    'append','prepend','expire','touch'):
-            def func(key, *args, **kwargs):
-                self.sync_mc.delete(key)
-                return getattr(self.mc, name)(key, *args, **kwargs)
-            return func
+    def _written(self, key):
+        if self.invalidate_queue is None:
+            self.sync_mc.delete(key)
         else:
-            return getattr(self.mc, name)
+            self.invalidate_queue.put(key, block=True)
+
+    def _written_multi(self, keys):
+        self.invalidate(list(keys))
+
+    def __getattr__(self, name):
+        return getattr(self.mc, name)
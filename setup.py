@@ -23,6 +23,7 @@ ENTRY_POINTS = """
 
 # dependencies
 INSTALL_REQUIRES = []
+EXTRAS_REQUIRE = {'xxhash': ['xxhash']}
 TESTS_REQUIRE = ['mock', 'nose']
 TEST_SUITE = 'nose.collector'
 
@@ -52,6 +53,7 @@ setup(
     zip_safe=False,
     entry_points=ENTRY_POINTS,
     install_requires=INSTALL_REQUIRES,
+    extras_require=EXTRAS_REQUIRE,
     tests_require=TESTS_REQUIRE,
     test_suite=TEST_SUITE,
 )
@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+""" test_decorator.py
+"""
+
+import os
+import inspect
+import signal
+import unittest
+import random
+import time
+import threading
+import array
+
+from douban.mc import mc_from_config
+from douban.mc import decorator
+from douban.mc.decorator import create_decorators, _Stored, \
+        compile_key_pattern, listcache_append, \
+        listcache_prepend
+from douban.mc.util import RequestScope
+from douban.mc.refresh import RefreshAhead
+from douban.utils import Empty, format
+from mock import patch
+
+
+class GenKeyTestCase(unittest.TestCase):
+    arg_names = ['id', 'kind', 'start']
+    defaults = ('a b', 0)
+
+    def assertSameKey(self, key_pattern, *a, **kw):
+        compiled = compile_key_pattern(key_pattern, self.arg_names,
+                                       self.defaults)
+        self.assertTrue(compiled is not None)
+        args = dict(zip(self.arg_names[-len(self.defaults):], self.defaults))
+        args.update(zip(self.arg_names, a))
+        args.update(kw)
+        if callable(key_pattern):
+            names = inspect.getargspec(key_pattern)[0]
+            key = key_pattern(*[args[n] for n in names])
+        else:
+            key = format(key_pattern,
+                         *[args[n] for n in self.arg_names], **args)
+        self.assertEqual(compiled(*a, **kw), key.replace(' ', '_'))
+
+    def test_compiled_key_should_match_format(self):
+        self.assertSameKey('k:{id}:{kind}:{start}', 1)
+        self.assertSameKey('k:{id}:{kind}:{start}', 1, 'x', start=3)
+        self.assertSameKey('k:{0}:{start:03d}:{kind!r}', 1, kind='y')
+        self.assertSameKey('{{k}}:{id}', 1)
+        self.assertSameKey(lambda id, start: 'k:%s:%s' % (id, start), 1, 2)
+        self.assertSameKey('k:{id}:{kind}', u'\u4e2d', kind=u'\xe9 x')
+        self.assertSameKey(u'k:{id}:{kind!r}', u'\u4e2d', kind=u'\xe9')
+
+    def test_complex_pattern_should_not_be_compiled(self):
+        self.assertEqual(compile_key_pattern('k:%s', self.arg_names,
+                                             self.defaults), None)
+        self.assertEqual(compile_key_pattern('k:{id.name}', self.arg_names,
+                                             self.defaults), None)
+        self.assertEqual(compile_key_pattern('k:{other}', self.arg_names,
+                                             self.defaults), None)
+
+    def test_compiled_key_should_require_args(self):
+        compiled = compile_key_pattern('k:{id}', self.arg_names, self.defaults)
+        self.assertRaises(KeyError, compiled, kind='x')
+
+
+class DecoratorTestCase(unittest.TestCase):
+    config = {
+        'servers': ['127.0.0.1:11211'],
+    }
+    mc = mc_from_config(config)
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.prefix = 'MCTEST:%s:%s' % (time.time(), random.random())
+        self.decorators = create_decorators(self.mc)
+
+    def test_cache_multi_should_only_load_missed_ids(self):
+        cache_multi = self.decorators['cache_multi']
+        calls = []
+
+        @cache_multi(self.prefix + ':{ids}')
+        def get_items(ids):
+            calls.append(sorted(ids))
+            return dict((i, i * 10) for i in ids if i != 3)
+
+        self.assertEqual(get_items([1, 2, 3]), {1: 10, 2: 20})
+        self.assertEqual(self.mc.get(self.prefix + ':1'), 10)
+        self.assertEqual(self.mc.get(self.prefix + ':3'), None)
+
+        self.assertEqual(get_items([1, 2, 4]), {1: 10, 2: 20, 4: 40})
+        self.assertEqual(calls, [[1, 2, 3], [4]])
+
+        get_items([1, 4], force=True)
+        self.assertEqual(calls[-1], [1, 4])
+
+    def test_cache_multi_should_take_ids_by_name(self):
+        cache_multi = self.decorators['cache_multi']
+
+        @cache_multi(self.prefix + ':{user_ids}:{kind}')
+        def get_users(user_ids, kind='a'):
+            return dict((i, '%s%d' % (kind, i)) for i in user_ids)
+
+        self.assertEqual(get_users(user_ids=[1, 2]), {1: 'a1', 2: 'a2'})
+        self.assertEqual(get_users(kind='b', user_ids=[1]), {1: 'b1'})
+        self.assertEqual(self.mc.get(self.prefix + ':1:b'), 'b1')
+        self.assertRaises(TypeError, get_users, kind='b')
+
+    def test_cache_multi_should_cache_empty(self):
+        cache_multi = self.decorators['cache_multi']
+        calls = []
+
+        @cache_multi(self.prefix + ':{ids}')
+        def get_items(ids):
+            calls.append(ids)
+            return dict((i, Empty()) for i in ids)
+
+        self.assertEqual(get_items([1]), {})
+        self.assertEqual(get_items([1]), {})
+        self.assertEqual(len(calls), 1)
+
+    def test_cache_single_flight_should_share_one_call(self):
+        cache = self.decorators['cache']
+        calls = []
+
+        @cache(self.prefix + ':{id}', single_flight=True)
+        def get_item(id):
+            calls.append(id)
+            time.sleep(0.2)
+            return id * 10
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_item(1)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [10] * 5)
+        self.assertEqual(calls, [1])
+
+    def test_cache_stale_should_serve_old_value_while_refreshing(self):
+        cache = self.decorators['cache']
+        key = self.prefix + ':1'
+        calls = []
+
+        @cache(self.prefix + ':{id}', expire=60, stale=60)
+        def get_item(id):
+            calls.append(id)
+            return len(calls)
+
+        self.assertEqual(get_item(1), 1)
+        self.assertEqual(get_item(1), 1)
+        self.mc.set(key, _Stored(1, time.time() - 1), 60)
+
+        # another process holds the refresh lease
+        self.mc.set(key + '#mutex', 1, 60)
+        self.assertEqual(get_item(1), 1)
+        self.assertEqual(len(calls), 1)
+
+        self.mc.delete(key + '#mutex')
+        self.assertEqual(get_item(1), 2)
+        self.assertEqual(get_item(1), 2)
+        self.assertEqual(self.mc.get(key + '#mutex'), None)
+
+    def test_cache_early_recompute(self):
+        cache = self.decorators['cache']
+        key = self.prefix + ':1'
+        calls = []
+
+        @cache(self.prefix + ':{id}', expire=60, early_recompute=True)
+        def get_item(id):
+            calls.append(id)
+            return Empty() if len(calls) == 1 else len(calls)
+
+        self.assertEqual(get_item(1), None)
+        stored = self.mc.get(key)
+        self.assertTrue(isinstance(stored, _Stored))
+        self.assertTrue(stored.deadline > time.time() + 50)
+
+        # cheap values far from their deadline are never recomputed
+        self.mc.set(key, _Stored(Empty(), time.time() + 60, 0), 60)
+        self.assertEqual(get_item(1), None)
+        self.assertEqual(len(calls), 1)
+
+        # expensive values close to their deadline are
+        self.mc.set(key, _Stored(Empty(), time.time() + 0.01, 10000), 60)
+        self.assertEqual(get_item(1), 2)
+        self.assertEqual(get_item(1), 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_pcache_should_call_with_the_args_of_the_call(self):
+        pcache = self.decorators['pcache']
+        calls = []
+
+        @pcache(self.prefix + ':{id}:{kind}', count=10)
+        def get_items(id, kind='a', start=0, limit=5):
+            calls.append((id, kind, start, limit))
+            return range(start, start + limit)
+
+        self.assertEqual(get_items(1, 'b', 2, 3), [2, 3, 4])
+        self.assertEqual(get_items(1, kind='b', limit=2), [0, 1])
+        self.assertEqual(get_items(1, start=8), range(8, 13))
+        self.assertEqual(get_items(1, start=1), range(1, 6))
+        self.assertEqual(calls, [(1, 'b', 0, 10), (1, 'a', 8, 5),
+                                 (1, 'a', 0, 10)])
+
+    def test_pcache_segment_should_only_compute_missed_pages(self):
+        pcache = self.decorators['pcache']
+        calls = []
+
+        @pcache(self.prefix + ':{id}', segment=10)
+        def get_items(id, start=0, limit=20):
+            calls.append((start, limit))
+            return range(start, min(start + limit, 1000))
+
+        self.assertEqual(get_items(1, start=5, limit=10), range(5, 15))
+        self.assertEqual(calls, [(0, 20)])
+        self.assertEqual(get_items(1, start=12, limit=20), range(12, 32))
+        self.assertEqual(calls, [(0, 20), (20, 20)])
+        self.assertEqual(get_items(1, start=995, limit=20), range(995, 1000))
+        self.assertEqual(get_items(1, start=0, limit=40), range(0, 40))
+        self.assertEqual(len(calls), 3)
+
+        # deleting the key invalidates all its pages
+        self.mc.delete(self.prefix + ':1')
+        self.assertEqual(get_items(1, start=0, limit=40), range(0, 40))
+        self.assertEqual(calls[-1], (0, 40))
+
+    def test_pcache_segment_should_replace_an_unsegmented_list(self):
+        pcache = self.decorators['pcache']
+        key = self.prefix + ':1'
+        self.mc.set(key, range(100))
+
+        @pcache(self.prefix + ':{id}', segment=10)
+        def get_items(id, start=0, limit=20):
+            return range(start, min(start + limit, 1000))
+
+        self.assertEqual(get_items(1, start=5, limit=10), range(5, 15))
+        gen = self.mc.get(key)
+        self.assertTrue(isinstance(gen, str))
+        self.assertEqual(self.mc.get(key + '#0'), (gen, None, range(10)))
+
+    def test_pcache2_segment(self):
+        pcache2 = self.decorators['pcache2']
+
+        @pcache2(self.prefix + ':{id}', segment=10)
+        def get_items(id, start=0, limit=20):
+            return 100, range(start, min(start + limit, 100))
+
+        self.assertEqual(get_items(1, start=5, limit=10), (100, range(5, 15)))
+        self.assertEqual(get_items(1, start=95, limit=10), (100, range(95, 100)))
+
+    @patch('douban.mc.decorator._MC_CHUNK_SIZE', 40)
+    def test_listcache_shard_should_cache_large_lists(self):
+        listcache = self.decorators['listcache']
+        key = self.prefix + ':1'
+        calls = []
+
+        @listcache(self.prefix + ':{id}', shard=True)
+        def get_ids(id):
+            calls.append(id)
+            return range(25)
+
+        self.assertEqual(list(get_ids(1)), range(25))
+        gen, n = self.mc.get(key)
+        self.assertEqual(n, 3)
+        self.assertEqual(self.mc.get(key + '#shards'), (gen, 3))
+        self.assertEqual(get_ids(1), tuple(range(25)))
+        self.assertEqual(len(calls), 1)
+
+        self.assertTrue(listcache_append(self.mc, key, [25, 26], shard=True))
+        self.assertTrue(listcache_prepend(self.mc, key, [100], shard=True))
+        self.assertEqual(get_ids(1), tuple([100] + range(27)))
+        self.assertEqual(len(self.mc.get('%s#%s#2' % (key, gen))), 4 * 7)
+        self.assertEqual(len(calls), 1)
+
+    @patch('douban.mc.decorator._MC_CHUNK_SIZE', 40)
+    def test_deleting_key_should_invalidate_sharded_list(self):
+        listcache = self.decorators['listcache']
+        key = self.prefix + ':1'
+        calls = []
+
+        @listcache(self.prefix + ':{id}', shard=True)
+        def get_ids(id):
+            calls.append(id)
+            return range(25 + len(calls))
+
+        self.assertEqual(list(get_ids(1)), range(26))
+        self.mc.delete(key)
+        self.assertEqual(list(get_ids(1)), range(27))
+        self.assertEqual(len(calls), 2)
+
+    def test_listcache_append_should_work_on_small_lists(self):
+        listcache = self.decorators['listcache']
+        key = self.prefix + ':1'
+
+        @listcache(self.prefix + ':{id}', shard=True)
+        def get_ids(id):
+            return [1, 2]
+
+        self.assertEqual(list(get_ids(1)), [1, 2])
+        self.assertTrue(listcache_append(self.mc, key, [3], shard=True))
+        self.assertEqual(get_ids(1), (1, 2, 3))
+        self.assertFalse(listcache_append(self.mc, self.prefix + ':2', [3],
+                                          shard=True))
+
+    @patch('douban.mc.decorator._MC_CHUNK_SIZE', 40)
+    def test_listcache_append_should_invalidate_without_shards_hint(self):
+        listcache = self.decorators['listcache']
+        key = self.prefix + ':1'
+        calls = []
+
+        @listcache(self.prefix + ':{id}', shard=True)
+        def get_ids(id):
+            calls.append(id)
+            return range(25)
+
+        self.assertEqual(list(get_ids(1)), range(25))
+        self.mc.delete(key + '#shards')
+        self.assertFalse(listcache_append(self.mc, key, [25], shard=True))
+        self.assertEqual(self.mc.get(key), None)
+        self.assertEqual(list(get_ids(1)), range(25))
+        self.assertEqual(len(calls), 2)
+
+    def test_listcache_as_array(self):
+        listcache = self.decorators['listcache']
+        calls = []
+
+        @listcache(self.prefix + ':{id}', as_array=True)
+        def get_ids(id):
+            calls.append(id)
+            return range(100)
+
+        for _ in range(2):
+            r = get_ids(1)
+            self.assertTrue(isinstance(r, array.array))
+            self.assertEqual(len(r), 100)
+            self.assertEqual(list(r[10:20]), range(10, 20))
+        self.assertEqual(len(calls), 1)
+        self.assertRaises(Exception, decorator.listcache(self.prefix, self.mc,
+                          fmt='<I', as_array=True), get_ids)
+
+    def test_request_scope_should_memoize_within_scope(self):
+        scope = RequestScope()
+        cache = create_decorators(self.mc, scope=scope)['cache']
+        other = mc_from_config(self.config, use_cache=False)
+        key = self.prefix + ':1'
+
+        @cache(self.prefix + ':{id}')
+        def get_item(id):
+            return 'a'
+
+        with scope:
+            self.assertEqual(get_item(1), 'a')
+            # written by another process
+            other.set(key, 'b')
+            self.assertEqual(get_item(1), 'a')
+        self.assertEqual(get_item(1), 'b')
+
+        with scope:
+            self.assertEqual(get_item(1), 'b')
+            other.set(key, 'c')
+            self.assertEqual(get_item(1), 'b')
+            self.assertEqual(get_item(1, force=True), 'a')
+            self.assertEqual(get_item(1), 'a')
+
+    def test_request_scope_should_read_its_own_writes(self):
+        scope = RequestScope()
+        cache = create_decorators(self.mc, scope=scope)['cache']
+        key = self.prefix + ':1'
+        calls = []
+
+        @cache(self.prefix + ':{id}')
+        def get_item(id):
+            calls.append(id)
+            return 'v%d' % len(calls)
+
+        with scope:
+            self.assertEqual(get_item(1), 'v1')
+            self.mc.delete(key)
+            self.assertEqual(get_item(1), 'v2')
+            self.mc.set(key, 'b')
+            self.assertEqual(get_item(1), 'b')
+            self.mc.delete_multi(k for k in [key])
+            self.assertEqual(get_item(1), 'v3')
+
+    def test_refresh_ahead_should_refresh_hot_keys(self):
+        cache = self.decorators['cache']
+        clients = []
+        def new_mc(mc):
+            self.assertTrue(mc is self.mc)
+            clients.append(mc_from_config(self.config, use_cache=False))
+            return clients[-1]
+        refresh = RefreshAhead(new_mc, hot_reads=3, ahead=0.9, jitter=0)
+        calls = []
+
+        @cache(self.prefix + ':{id}', expire=1, refresh_ahead=refresh)
+        def get_item(id):
+            calls.append(id)
+            return len(calls)
+
+        @cache(self.prefix + ':cold:{id}', expire=1, refresh_ahead=refresh)
+        def get_cold_item(id):
+            calls.append(id)
+            return len(calls)
+
+        for _ in range(3):
+            self.assertEqual(get_item(1), 1)
+        get_cold_item(2)
+        time.sleep(0.3)
+        refresh.stop()
+        self.assertEqual(calls, [1, 2, 1])
+        self.assertEqual(self.mc.get(self.prefix + ':1').value, 3)
+        self.assertEqual(refresh.stats, dict(refreshed=1, skipped=0, failed=0))
+        self.assertEqual(len(clients), 1)
+
+    def test_refresh_ahead_should_schedule_from_the_stored_deadline(self):
+        cache = self.decorators['cache']
+        refresh = RefreshAhead(
+            lambda mc: mc_from_config(self.config, use_cache=False),
+            hot_reads=3, ahead=0.1)
+
+        @cache(self.prefix + ':{id}', expire=10, refresh_ahead=refresh)
+        def get_item(id):
+            return id
+
+        get_item(1)
+        time.sleep(0.2)
+        get_item(1)
+        get_item(1)
+        deadline = self.mc.get(self.prefix + ':1').deadline
+        [(when, key)] = refresh.heap
+        self.assertEqual(key, self.prefix + ':1')
+        # up to half the 1 second ahead later, by default
+        self.assertTrue(deadline - 1 <= when <= deadline - 0.5)
+        refresh.stop()
+
+    def test_refresh_ahead_should_skip_keys_refreshed_elsewhere(self):
+        cache = self.decorators['cache']
+        refresh = RefreshAhead(
+            lambda mc: mc_from_config(self.config, use_cache=False),
+            hot_reads=1, ahead=0.9, jitter=0)
+        calls = []
+
+        @cache(self.prefix + ':{id}', expire=1, refresh_ahead=refresh)
+        def get_item(id):
+            calls.append(id)
+            return len(calls)
+
+        # being refreshed by another process
+        self.mc.add(self.prefix + ':1#mutex', 1, 10)
+        get_item(1)
+        get_item(2)
+        # refreshed by another process
+        self.mc.set(self.prefix + ':2', _Stored(3, time.time() + 5), 5)
+        time.sleep(0.3)
+        refresh.stop()
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(refresh.stats, dict(refreshed=0, skipped=2, failed=0))
+        self.assertEqual(self.mc.get(self.prefix + ':1#mutex'), 1)
+        self.assertEqual(self.mc.get(self.prefix + ':2#mutex'), None)
+
+    def test_refresh_ahead_should_start_afresh_after_fork(self):
+        refresh = RefreshAhead(
+            lambda mc: mc_from_config(self.config, use_cache=False),
+            hot_reads=1, ahead=0.5, jitter=0)
+        key = self.prefix + ':1'
+        stored = []
+        store = lambda client, value: stored.append(value)
+        refresh.read(key, 10, time.time() + 10, self.mc, store, 1)
+        # cond held by a worker of the parent
+        held, done = threading.Event(), threading.Event()
+        def hold():
+            with refresh.cond:
+                held.set()
+                done.wait()
+        t = threading.Thread(target=hold)
+        t.start()
+        held.wait()
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(5)
+            refresh.read(key, 1, time.time() + 0.5, self.mc, store, 2)
+            time.sleep(0.3)
+            os._exit(0 if stored == [2] and refresh.threads else 1)
+        done.set()
+        t.join()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(refresh.heap[0][1], key)
+        refresh.stop()
+        self.assertEqual(stored, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,15 +4,26 @@
 """ test_mc.py
 """
 
+import os
 import unittest
 import random
 import time
+import signal
+import tempfile
+import threading
 
 import cmemcached
-from douban.mc import mc_from_config
+from douban.mc import mc_from_config, async_clean
 from douban.mc.wrapper import AdjustMC, Replicated, LocalCached, \
-        VersionedLocalCached
-from mock import patch, Mock, call
+        VersionedLocalCached, SharedLocalCached, SyncMC, HotKeyCached, \
+        estimate_size, fingerprint
+from douban.mc import shm
+from douban.mc.shm import SegmentMismatch
+from douban.mc.util import BatchQueue, CuckooFilter, HeavyHitters
+from douban.mc.migrate import Drainer, read_keys, load_old_keys
+from douban.mc.hedge import HedgedReader, LatencyTracker
+from douban.mc.debug import LocalMemcache
+from mock import patch, Mock, call, ANY
 
 class PureMCTest(unittest.TestCase):
     config = {
@@ -108,6 +119,19 @@ class AdjustMCTest(PureMCTest):
     def test_wrapper_is_right(self):
         self.assertTrue(isinstance(self.mc.mc, AdjustMC))
 
+class AdjustMCRoutingTestCase(unittest.TestCase):
+    def test_moved_keys_should_remember_routing(self):
+        old, new = Mock(), Mock()
+        old.get_host_by_key.side_effect = lambda k: k[-1]
+        new.get_host_by_key.side_effect = lambda k: 'a'
+        mc = AdjustMC(old, new, route_cache_size=3)
+        self.assertEqual(mc.moved_keys(['ka', 'kb', 'kc']), ['kb', 'kc'])
+        self.assertTrue(mc.moved('kb'))
+        self.assertFalse(mc.moved('ka'))
+        self.assertEqual(old.get_host_by_key.call_count, 3)
+        self.assertEqual(mc.moved_keys(['kd', 'ka']), ['kd'])
+        self.assertEqual(len(mc._moved), 2)
+
 class ReplicatedTest(PureMCTest):
     config = {
         'servers': ['127.0.0.1:11211'],
@@ -119,6 +143,619 @@ class ReplicatedTest(PureMCTest):
     def test_wrapper_is_right(self):
         self.assertTrue(isinstance(self.mc.mc, Replicated))
 
+class ReadRepairTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.master = Mock(wraps=LocalMemcache())
+        self.backup = LocalMemcache()
+        self.backup.set_multi({'a': 1, 'b': 2, 'c': 3})
+
+    def test_replicated_should_repair_in_one_set_multi(self):
+        mc = Replicated(self.master, self.backup)
+        self.assertEqual(mc.get_multi(['a', 'b', 'c', 'd']),
+                         {'a': 1, 'b': 2, 'c': 3})
+        self.master.set_multi.assert_called_once_with(
+            {'a': 1, 'b': 2, 'c': 3}, 600)
+        self.assertFalse(self.master.set.called)
+
+    def test_replicated_should_repair_in_background(self):
+        writer = Mock(wraps=self.master._mock_wraps)
+        mc = Replicated(self.master, self.backup, repair_writer=writer)
+        self.assertEqual(mc.get_list(['a', 'b']), [1, 2])
+        self.assertEqual(mc.get('c'), 3)
+        mc.set('c', 4)
+        mc.repair_queue.flush()
+        self.assertEqual(self.master.get_multi(['a', 'b', 'c']),
+                         {'a': 1, 'b': 2, 'c': 4})
+        self.assertFalse(self.master.set_multi.called)
+        self.assertTrue(writer.set_multi.called)
+
+    def test_adjust_mc_should_migrate_in_batches(self):
+        old = Mock(wraps=LocalMemcache())
+        old.set_multi({'a': 1, 'b': 2})
+        old.get_host_by_key = lambda k: 'old'
+        new = Mock(wraps=LocalMemcache())
+        new.get_host_by_key = lambda k: 'new'
+        migrators = (Mock(wraps=old._mock_wraps),
+                     Mock(wraps=new._mock_wraps))
+        mc = AdjustMC(old, new, migrators=migrators)
+        mc._migrate_queue.interval = 0.05
+        self.assertEqual(mc.get_multi(['a', 'b']), {'a': 1, 'b': 2})
+        mc._migrate_queue.flush()
+        self.assertFalse(new.set_multi.called)
+        self.assertFalse(old.delete_multi.called)
+        self.assertEqual(migrators[1].set_multi.call_count, 1)
+        self.assertEqual(migrators[0].delete_multi.call_count, 1)
+        self.assertEqual(new.get_multi(['a', 'b']), {'a': 1, 'b': 2})
+        self.assertEqual(old.get_multi(['a', 'b']), {})
+
+    def test_stop_should_close_the_background_clients(self):
+        writer = Mock()
+        mc = Replicated(self.master, self.backup, repair_writer=writer)
+        self.assertEqual(mc.get('a'), 1)
+        threads = mc.repair_queue.threads
+        mc.stop()
+        for t in threads:
+            self.assertFalse(t.is_alive())
+        writer.set_multi.assert_called_once_with({'a': 1}, 600)
+        self.assertTrue(writer.close.called)
+        self.assertFalse(mc.repair_queue.put('b', 2))
+
+    def test_reload_should_stop_the_old_queues(self):
+        config = {'servers': ['127.0.0.1:11211'],
+                  'backup_servers': ['127.0.0.1:11211'],
+                  'async_repair': True}
+        mc = mc_from_config(config, use_cache=False)
+        old = mc.mc
+        old.repair_queue.put('MCTEST:repair', 1)
+        threads = old.repair_queue.threads
+        self.assertTrue(threads)
+        mc.parse_config(dict(config, log_every_actions=False))
+        self.assertTrue(mc.mc is not old)
+        for t in threads:
+            self.assertFalse(t.is_alive())
+
+class DrainerTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.old = Mock(wraps=LocalMemcache())
+        self.old.get_host_by_key = lambda k: 'old' if k != 'e' else 'new'
+        self.new = Mock(wraps=LocalMemcache())
+        self.new.get_host_by_key = lambda k: 'new'
+        self.old.set_multi({'a': 1, 'b': 2, 'c': 3, 'e': 5})
+        self.new.set('b', 20)
+        self.mc = AdjustMC(self.old, self.new)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        unittest.TestCase.tearDown(self)
+
+    def test_should_move_keys_in_batches(self):
+        reports = []
+        drainer = Drainer(self.mc, batch_size=2, rate=0,
+                          report=lambda s: reports.append(dict(s)))
+        stats = drainer.drain(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(stats, dict(scanned=5, moved=4, copied=2, deleted=3))
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(self.new.get_multi(['a', 'b', 'c']),
+                         {'a': 1, 'b': 20, 'c': 3})
+        self.assertEqual(self.old.get_multi(['a', 'b', 'c', 'e']), {'e': 5})
+        self.assertEqual(self.new.set_multi.call_count, 2)
+        self.assertEqual(self.old.delete_multi.call_count, 2)
+        self.assertFalse(self.new.add.called)
+
+    def test_should_not_overwrite_values_on_new(self):
+        self.new.set('a', 100)
+        stats = Drainer(self.mc, rate=0).drain(['a', 'b', 'c'])
+        self.assertEqual(stats['copied'], 1)
+        self.assertEqual(stats['deleted'], 3)
+        self.assertEqual(self.new.get_multi(['a', 'b', 'c']),
+                         {'a': 100, 'b': 20, 'c': 3})
+        self.new.set_multi.assert_called_once_with({'c': 3}, ANY,
+                                                   return_failure=True)
+        self.assertEqual(self.old.get_multi(['a', 'b', 'c']), {})
+
+    def test_should_keep_values_failed_to_copy(self):
+        self.new.set_multi.side_effect = \
+                lambda values, time=0, return_failure=False: \
+                (False, values.keys())
+        stats = Drainer(self.mc, rate=0).drain(['a', 'b'])
+        self.assertEqual(stats['copied'], 0)
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(self.old.get_multi(['a', 'b']), {'a': 1})
+
+    def test_should_resume_from_checkpoint(self):
+        Drainer(self.mc, batch_size=2, rate=0,
+                checkpoint=self.path).drain(['a', 'b'])
+        self.old.set('a', 10)
+        stats = Drainer(self.mc, batch_size=2, rate=0,
+                        checkpoint=self.path).drain(['a', 'b', 'c'])
+        self.assertEqual(stats['scanned'], 1)
+        self.assertEqual(self.old.get('a'), 10)
+        self.assertEqual(open(self.path).read(), '3\n')
+
+    def test_read_keys_should_parse_metadump(self):
+        with open(self.path, 'w') as f:
+            f.write('key=a%20b exp=-1 la=1 cas=2 fetch=no cls=1 size=63\n'
+                    'c\n\n')
+        self.assertEqual(list(read_keys(self.path)), ['a b', 'c'])
+
+class CuckooFilterTestCase(unittest.TestCase):
+    def test_should_hold_keys_until_discarded(self):
+        keys = ['key%d' % i for i in range(1000)]
+        f = CuckooFilter.from_keys(keys, len(keys))
+        self.assertEqual(len(f), 1000)
+        self.assertFalse(f.overflowed)
+        self.assertTrue(all(k in f for k in keys))
+        others = sum(1 for i in range(10000) if 'other%d' % i in f)
+        self.assertTrue(others < 10)
+        f.discard('key1')
+        self.assertFalse('key1' in f)
+        self.assertEqual(len(f), 999)
+
+    def test_should_answer_true_once_overflowed(self):
+        f = CuckooFilter(4)
+        for i in range(100):
+            f.add('key%d' % i)
+        self.assertTrue(f.overflowed)
+        self.assertTrue('other' in f)
+
+    def test_adjust_mc_should_skip_keys_not_on_old(self):
+        old = Mock(wraps=LocalMemcache())
+        old.set_multi({'a': 1, 'b': 2})
+        old.get_host_by_key = lambda k: 'old'
+        new = Mock(wraps=LocalMemcache())
+        new.get_host_by_key = lambda k: 'new'
+        mc = AdjustMC(old, new, old_keys=CuckooFilter.from_keys('ab', 2))
+        self.assertEqual(mc.get('c'), None)
+        self.assertFalse(old.get.called)
+        self.assertEqual(mc.get_multi(['a', 'c']), {'a': 1})
+        old.get_multi.assert_called_once_with(['a'])
+        self.assertEqual(mc.left_on_old(['a', 'b']), ['b'])
+        self.assertEqual(mc.get_multi(['a']), {'a': 1})
+        self.assertEqual(old.get_multi.call_count, 1)
+
+    def test_adjust_mc_should_only_forget_keys_found_on_old(self):
+        old = Mock(wraps=LocalMemcache())
+        old.get_host_by_key = lambda k: 'old'
+        new = Mock(wraps=LocalMemcache())
+        new.get_host_by_key = lambda k: 'new'
+        old_keys = CuckooFilter.from_keys('a', 1)
+        mc = AdjustMC(old, new, old_keys=old_keys)
+        with patch.object(old_keys, 'discard') as discard:
+            mc.delete('b')
+            mc.delete_multi(['c', 'd'])
+            self.assertFalse(discard.called)
+            old.set('a', 1)
+            self.assertEqual(mc.get('a'), 1)
+            discard.assert_called_once_with('a')
+
+    def test_load_old_keys_should_build_the_filter_once(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, 'a\nb\n')
+        os.close(fd)
+        try:
+            f = load_old_keys(path)
+            self.assertTrue('a' in f and 'b' in f)
+            self.assertTrue(load_old_keys(path) is f)
+        finally:
+            os.remove(path)
+
+class HedgedReadTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.master = LocalMemcache()
+        self.backup = LocalMemcache()
+        self.master.set_multi({'a': 1, 'b': 2})
+        self.backup.set_multi({'a': 10, 'b': 20, 'c': 30})
+        self.delay = 0
+
+    def new_master(self):
+        master = Mock(wraps=self.master)
+        def get(key):
+            time.sleep(self.delay)
+            return self.master.get(key)
+        master.get.side_effect = get
+        return master
+
+    def test_latency_tracker_percentile(self):
+        t = LatencyTracker(window=100, every=10)
+        self.assertEqual(t.percentile(0.9), None)
+        for i in range(100):
+            t.record(i)
+        self.assertEqual(t.percentile(0.9), 90)
+        t.record(1000)
+        self.assertEqual(t.percentile(0.9), 90)
+
+    def test_should_read_backup_when_master_is_slow(self):
+        hedge = HedgedReader(self.new_master, lambda: self.backup,
+                             min_delay=0.01, workers=2)
+        mc = Replicated(self.master, self.backup, hedge=hedge)
+        self.assertEqual(mc.get('a'), 1)
+        self.assertEqual(mc.get('c'), 30)
+        self.assertEqual(hedge.stats['hedged'], 0)
+        self.delay = 0.2
+        self.assertEqual(mc.get('a'), 10)
+        self.assertEqual(hedge.stats['hedged'], 1)
+        self.assertEqual(hedge.stats['backup_wins'], 1)
+        self.assertEqual(mc.get_multi(['a', 'c']), {'a': 1, 'c': 30})
+
+    def test_falsy_master_values_should_win(self):
+        def new_backup():
+            backup = Mock(wraps=self.backup)
+            def get(key):
+                time.sleep(0.3)
+                return self.backup.get(key)
+            backup.get.side_effect = get
+            return backup
+        hedge = HedgedReader(self.new_master, new_backup,
+                             min_delay=0.01, workers=2)
+        mc = Replicated(self.master, self.backup, hedge=hedge)
+        self.master.set('z', 0)
+        self.backup.set('z', 5)
+        self.delay = 0.03
+        t = time.time()
+        self.assertEqual(mc.get('z'), 0)
+        self.assertTrue(time.time() - t < 0.2)
+        self.assertEqual(hedge.stats['hedged'], 1)
+        self.assertEqual(hedge.stats['backup_wins'], 0)
+
+    def test_backup_reads_should_not_wait_for_primary_workers(self):
+        hedge = HedgedReader(self.new_master, lambda: self.backup,
+                             min_delay=0.01, workers=1)
+        mc = Replicated(self.master, self.backup, hedge=hedge)
+        self.delay = 0.3
+        results = []
+        def read():
+            t = time.time()
+            results.append((mc.get('a'), time.time() - t))
+        threads = [threading.Thread(target=read) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([v for v, t in results], [10, 10])
+        self.assertTrue(max(t for v, t in results) < 0.2)
+
+    def test_hedged_get_multi_should_merge_both_answers(self):
+        def new_master():
+            master = Mock(wraps=self.master)
+            def get_multi(keys):
+                time.sleep(0.05)
+                return self.master.get_multi(keys)
+            master.get_multi.side_effect = get_multi
+            return master
+        hedge = HedgedReader(new_master, lambda: self.backup,
+                             min_delay=0.01, workers=2)
+        mc = Replicated(self.master, self.backup, hedge=hedge)
+        self.assertEqual(mc.get_multi(['a', 'b', 'c', 'd']),
+                         {'a': 1, 'b': 2, 'c': 30})
+        self.assertEqual(hedge.stats['hedged'], 1)
+        self.assertEqual(hedge.stats['backup_wins'], 1)
+
+    def test_should_read_by_itself_when_workers_are_busy(self):
+        hedge = HedgedReader(self.new_master, lambda: self.backup,
+                             workers=1, max_pending=1)
+        primary = hedge.pools[0]
+        primary.queue.put(None)
+        primary.pid = os.getpid()
+        mc = Replicated(self.master, self.backup, hedge=hedge)
+        self.assertEqual(mc.get('a'), 1)
+        self.assertEqual(hedge.stats['fallbacks'], 1)
+
+    def test_stop_should_release_the_workers(self):
+        closed = []
+        def new_client(new):
+            client = new()
+            client.close = lambda: closed.append(new)
+            return client
+        new_backup = lambda: Mock(wraps=self.backup)
+        hedge = HedgedReader(lambda: new_client(self.new_master),
+                             lambda: new_client(new_backup),
+                             min_delay=0.01, workers=2)
+        writer, repair_writer = Mock(), Mock()
+        mc = Replicated(self.master, self.backup, hedge=hedge,
+                        replica_writer=writer, repair_writer=repair_writer)
+        self.delay = 0.05
+        self.assertEqual(mc.get('a'), 10)
+        mc.set('b', 3)
+        threads = hedge.pools[0].threads + hedge.pools[1].threads + \
+                mc.replica_queue.threads
+        self.assertEqual(len(threads), 5)
+        mc.stop()
+        for t in threads:
+            self.assertFalse(t.is_alive())
+        self.assertEqual(closed, [self.new_master] * 2 + [new_backup] * 2)
+        writer.set_multi.assert_called_once_with({'b': 3}, 0, True)
+        self.assertTrue(writer.close.called)
+        self.assertTrue(repair_writer.close.called)
+        self.assertEqual(mc.get('c'), 30)
+        self.assertEqual(hedge.stats['fallbacks'], 1)
+        self.assertFalse(mc.replica_queue.put('b', None))
+
+    def test_reload_should_stop_the_old_workers(self):
+        config = {'servers': ['127.0.0.1:11211'],
+                  'backup_servers': ['127.0.0.1:11211'],
+                  'hedged_reads': True, 'async_replica_writes': True}
+        mc = mc_from_config(config, use_cache=False)
+        old = mc.mc
+        mc.get('MCTEST:hedged')
+        mc.set('MCTEST:hedged', 1)
+        threads = old.hedge.pools[0].threads + old.replica_queue.threads
+        self.assertTrue(threads)
+        mc.parse_config(dict(config, hedged_reads=0.9))
+        self.assertTrue(mc.mc is not old)
+        for t in threads:
+            self.assertFalse(t.is_alive())
+
+class AsyncReplicaWriteTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.master = LocalMemcache()
+        self.rep = Mock(wraps=LocalMemcache())
+
+    def test_should_coalesce_replica_writes(self):
+        mc = Replicated(self.master, self.rep, replica_writer=self.rep)
+        mc.replica_queue.interval = 0.05
+        mc.set('a', 1, 100)
+        mc.set('b', 2, 100)
+        mc.set('c', 3, 100)
+        mc.delete('c')
+        mc.set_multi({'d': 4})
+        mc.replica_queue.flush()
+        self.assertFalse(self.rep.set.called)
+        self.assertFalse(self.rep.delete.called)
+        self.rep.set_multi.assert_called_once_with({'a': 1, 'b': 2}, 50, True)
+        self.assertEqual(self.rep.delete_multi.call_count, 1)
+        self.assertEqual(sorted(self.rep.delete_multi.call_args[0][0]),
+                         ['c', 'd'])
+        self.assertEqual(self.rep.get_multi(['a', 'b', 'c', 'd']),
+                         {'a': 1, 'b': 2})
+        self.assertEqual(mc.replica_queue.lag(), 0)
+
+    def test_should_queue_raw_writes(self):
+        mc = Replicated(self.master, self.rep, replica_writer=self.rep)
+        mc.replica_queue.interval = 0.05
+        data, flag = cmemcached.prepare([1], 0)
+        mc.set_raw('a', data, 100, flag)
+        mc.set('b', 2, 100)
+        self.assertFalse(self.rep.set_raw.called)
+        mc.replica_queue.flush()
+        self.rep.set_raw.assert_called_once_with('a', data, 50, flag)
+        self.rep.set_multi.assert_called_once_with({'b': 2}, 50, True)
+        self.assertFalse(self.rep.delete_multi.called)
+        self.assertEqual(self.rep.get('a'), [1])
+
+    def test_should_not_read_rep_before_queued_writes(self):
+        mc = Replicated(self.master, self.rep, replica_writer=self.rep)
+        mc.replica_queue.interval = 0.2
+        self.master.set_multi({'a': 1, 'b': 2})
+        self.rep.set_multi({'a': 1, 'b': 2, 'c': 3})
+        mc.delete('a')
+        mc.delete_multi(['b'])
+        self.assertEqual(mc.get('a'), None)
+        self.assertEqual(mc.get_multi(['a', 'b', 'c']), {'c': 3})
+        self.assertEqual(self.master.get_multi(['a', 'b']), {})
+        mc.replica_queue.flush()
+        self.assertEqual(self.rep.get_multi(['a', 'b', 'c']), {'c': 3})
+
+    def test_should_not_read_rep_during_replica_writes(self):
+        writing, done = threading.Event(), threading.Event()
+        def delete_multi(keys):
+            writing.set()
+            done.wait(1)
+            return LocalMemcache.delete_multi(self.rep._mock_wraps, keys)
+        self.rep.delete_multi.side_effect = delete_multi
+        mc = Replicated(self.master, self.rep, replica_writer=self.rep)
+        self.master.set('a', 1)
+        self.rep.set('a', 1)
+        mc.delete('a')
+        self.assertTrue(writing.wait(1))
+        self.assertEqual(mc.replica_queue.pending, {})
+        self.assertEqual(mc.get('a'), None)
+        self.assertEqual(mc.get_multi(['a']), {})
+        done.set()
+        mc.replica_queue.flush()
+        self.assertFalse('a' in mc.replica_queue)
+        self.assertEqual(self.master.get('a'), None)
+
+    def test_should_delete_inline_when_full(self):
+        mc = Replicated(self.master, self.rep, replica_writer=self.rep)
+        mc.replica_queue.maxsize = 0
+        self.rep.set('a', 0)
+        mc.set('a', 1)
+        self.rep.delete.assert_called_once_with('a')
+        self.assertEqual(mc.replica_queue.stats['dropped'], 1)
+        self.assertEqual(mc.get('a'), 1)
+
+class SyncMCTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.main = LocalMemcache()
+        self.sync = Mock(wraps=LocalMemcache())
+        self.sync.set_multi({'a': 0, 'b': 0, 'c': 0})
+
+    def test_should_invalidate_before_writing(self):
+        mc = SyncMC(self.main, self.sync)
+        mc.set('a', 1)
+        self.sync.delete.assert_called_once_with('a')
+        mc.set_multi({'b': 2, 'c': 3})
+        self.assertEqual(sorted(self.sync.delete_multi.call_args[0][0]),
+                         ['b', 'c'])
+        self.assertEqual(self.sync.get_multi(['a', 'b', 'c']), {})
+        self.assertEqual(mc.get_multi(['a', 'b', 'c']),
+                         {'a': 1, 'b': 2, 'c': 3})
+
+    def test_should_invalidate_in_batches(self):
+        mc = SyncMC(self.main, self.sync, async_invalidate=True, window=0.05)
+        mc.set('a', 1)
+        mc.set('a', 2)
+        mc.delete_multi(['b', 'c'])
+        mc.flush()
+        self.assertFalse(self.sync.delete.called)
+        self.assertEqual(self.sync.delete_multi.call_count, 1)
+        self.assertEqual(self.sync.get_multi(['a', 'b', 'c']), {})
+        self.assertEqual(mc.invalidate_queue.stats['merged'], 1)
+        self.assertEqual(mc.get('a'), 2)
+
+    def test_should_retry_failed_invalidations(self):
+        self.sync.delete_multi.side_effect = [False, True]
+        mc = SyncMC(self.main, self.sync, async_invalidate=True, window=0.01)
+        mc.set('a', 1)
+        mc.flush()
+        self.assertEqual(self.sync.delete_multi.call_count, 2)
+        self.assertEqual(mc.invalidate_queue.stats['handled'], 1)
+
+class ForwardWritersTestCase(unittest.TestCase):
+    def test_writers_should_be_defined_once(self):
+        for cls in (AdjustMC, Replicated, LocalCached, SharedLocalCached,
+                    SyncMC):
+            self.assertTrue('delete' in cls.__dict__)
+            self.assertTrue('set_multi' in cls.__dict__)
+            self.assertEqual(cls.delete.__name__, 'delete')
+        mc = Replicated(LocalCached(LocalMemcache()), LocalMemcache())
+        self.assertFalse(hasattr(mc, '__dict__'))
+        self.assertRaises(AttributeError, setattr, mc, 'foo', 1)
+        self.assertTrue(mc.add('a', 1))
+        mc.rep.set('a', 2)
+        self.assertEqual(mc.delete('a'), 1)
+        self.assertEqual(mc.rep.get('a'), None)
+        self.assertEqual(mc.get_last_error(), 0)
+
+class HotKeyCachedTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.backend = Mock(wraps=LocalMemcache())
+        self.backend.set_multi({'hot': 1, 'cold': 2})
+
+    def test_heavy_hitters_should_keep_top_keys(self):
+        hh = HeavyHitters(width=64, depth=4, top=2)
+        for i in range(100):
+            hh.add('a')
+            if i % 2:
+                hh.add('b')
+            hh.add('c%d' % i)
+        self.assertEqual([k for k, c in hh.top_keys()], ['a', 'b'])
+        self.assertTrue(hh.estimate('a') >= 100)
+        hh.decay()
+        self.assertEqual(hh.top_keys()[0], ('a', hh.estimate('a')))
+        self.assertTrue(hh.estimate('a') >= 50)
+
+    def test_heavy_hitters_should_evict_the_least_counted_key(self):
+        hh = HeavyHitters(width=4096, depth=4, top=2)
+        hh.add('a', 5)
+        hh.add('b', 5)
+        hh.add('a', 5)
+        hh.add('b', 7)
+        # colder than both a and b
+        hh.add('c', 6)
+        self.assertEqual(hh.top, {'a': 10, 'b': 12})
+        self.assertEqual(hh.floor, 10)
+        hh.add('c', 5)
+        self.assertEqual(hh.top, {'b': 12, 'c': 11})
+
+    def test_should_cache_hot_keys_only(self):
+        mc = HotKeyCached(self.backend, threshold=10, sample=1, ttl=10)
+        for i in range(20):
+            self.assertEqual(mc.get('hot'), 1)
+        self.assertEqual(mc.get_multi(['hot', 'cold']), {'hot': 1, 'cold': 2})
+        self.assertEqual([k for k, c in mc.hot_keys()], ['hot'])
+        self.assertEqual(self.backend.get.call_count, 10)
+        self.assertEqual(self.backend.get_multi.call_args[0][0], ['cold'])
+        mc.set('hot', 3)
+        self.assertEqual(mc.get('hot'), 3)
+        self.assertEqual(mc.get_list(['hot']), [3])
+        self.assertEqual(self.backend.get.call_count, 11)
+
+    def test_should_cool_keys_down(self):
+        mc = HotKeyCached(self.backend, threshold=10, sample=1, window=60)
+        for i in range(10):
+            mc.get('hot')
+        self.assertEqual(mc.stats['promoted'], 1)
+        mc.decayed -= 60
+        mc.get('cold')
+        mc.decayed -= 60
+        mc.get('cold')
+        self.assertEqual(mc.hot_keys(), [])
+        self.assertEqual(mc.stats['demoted'], 1)
+        self.assertFalse('hot' in mc.cached)
+
+    def test_manager_should_plug_it_from_config(self):
+        mc = mc_from_config({'servers': [], 'disabled': True,
+                             'hot_keys': {'threshold': 5}}, use_cache=False)
+        self.assertTrue(isinstance(mc.mc, HotKeyCached))
+        self.assertEqual(mc.mc.threshold, 5)
+
+class BatchQueueTestCase(unittest.TestCase):
+    def test_should_merge_and_batch_items(self):
+        batches = []
+        q = BatchQueue(batches.append, maxsize=3, batch_size=2, interval=0.05)
+        self.assertTrue(q.put('a', 1))
+        self.assertTrue(q.put('b', 1))
+        self.assertTrue(q.put('a', 2))
+        q.flush()
+        self.assertEqual(batches, [{'a': 2, 'b': 1}])
+        self.assertEqual(q.stats['merged'], 1)
+        self.assertEqual(q.lag(), 0)
+
+    def test_should_drop_when_full_and_retry_failures(self):
+        calls = []
+        def handler(items):
+            calls.append(items)
+            if len(calls) == 1:
+                raise Exception('failed')
+        q = BatchQueue(handler, maxsize=2, interval=0.05, retries=1)
+        self.assertTrue(q.put('a'))
+        self.assertTrue(q.put('b'))
+        self.assertFalse(q.put('c'))
+        q.flush()
+        self.assertEqual(calls, [{'a': None, 'b': None}] * 2)
+        self.assertEqual(q.stats['dropped'], 1)
+        self.assertEqual(q.stats['handled'], 2)
+
+    def test_stop_should_handle_waiting_items_first(self):
+        batches = []
+        q = BatchQueue(batches.append, interval=0.05)
+        q.put('a', 1)
+        threads = q.threads
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(q.stop())
+        self.assertFalse(threads[0].is_alive())
+        self.assertEqual(batches, [{'a': 1}])
+        self.assertFalse(q.put('b', 2))
+        self.assertEqual(q.stats['dropped'], 1)
+
+    def test_should_start_afresh_after_fork(self):
+        batches = []
+        q = BatchQueue(batches.append, interval=0.2)
+        q.put('a', 1)
+        time.sleep(0.05)
+        # cond held by another thread, while 'a' is being handled
+        held, done = threading.Event(), threading.Event()
+        def hold():
+            with q.cond:
+                held.set()
+                done.wait()
+        t = threading.Thread(target=hold)
+        t.start()
+        held.wait()
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(5)
+            q.put('b', 2)
+            ok = 'a' not in q
+            q.flush()
+            os._exit(0 if ok and batches == [{'b': 2}] else 1)
+        done.set()
+        t.join()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        q.flush()
+        self.assertEqual(batches, [{'a': 1}])
+
 class LocalCachedTest(PureMCTest):
     config = {
         'servers': ['127.0.0.1:11211'],
@@ -128,6 +765,200 @@ class LocalCachedTest(PureMCTest):
     def test_wrapper_is_right(self):
         self.assertTrue(isinstance(self.mc, LocalCached))
 
+class LocalCachedEvictionTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.backend = LocalMemcache()
+        self.mc = LocalCached(self.backend, size=3)
+
+    def test_should_evict_least_recently_used(self):
+        for k in 'abc':
+            self.mc.set(k, k)
+        self.assertEqual(self.mc.get('a'), 'a')
+        self.mc.set('d', 'd')
+        self.assertEqual(sorted(self.mc.dataset), ['a', 'c', 'd'])
+        self.assertEqual(self.mc.stats['evictions'], 1)
+
+        self.backend.set('a', 'a2')
+        self.assertEqual(self.mc.get('a'), 'a')
+        self.assertEqual(self.mc.get('b'), 'b')
+        self.assertEqual(self.mc.stats['hits'], 2)
+        self.assertEqual(self.mc.stats['misses'], 1)
+
+    def test_should_drop_on_delete(self):
+        self.mc.set('a', 'a')
+        self.mc.delete('a')
+        self.assertEqual(self.mc.dataset, {})
+        self.assertEqual(self.mc.get('a'), None)
+
+    def test_ttl_should_expire_local_copy(self):
+        mc = LocalCached(self.backend, size=3, ttl=0.1)
+        mc.set('a', 'a')
+        self.backend.set('a', 'a2')
+        self.assertEqual(mc.get('a'), 'a')
+        time.sleep(0.15)
+        self.assertEqual(mc.get('a'), 'a2')
+
+    def test_max_bytes_should_bound_estimated_size(self):
+        mc = LocalCached(self.backend, size=100, max_bytes=2000)
+        for i in range(10):
+            mc.set('key%d' % i, 'x' * 500)
+        usage = mc.usage()
+        self.assertTrue(usage['bytes'] <= 2000)
+        self.assertEqual(usage['entries'], 2)
+        self.assertTrue('key9' in mc.dataset)
+
+        mc.set('big', 'x' * 3000)
+        self.assertFalse('big' in mc.dataset)
+        mc.delete('key9')
+        self.assertEqual(mc.usage()['entries'], 1)
+        self.assertEqual(mc.usage()['bytes'], 500 + 4 + 200)
+
+    def test_estimate_size_should_not_serialize(self):
+        value = {'ids': range(1000), 'names': ['x' * 100] * 100}
+        with patch('cmemcached.prepare') as prepare:
+            size = estimate_size(value)
+        self.assertFalse(prepare.called)
+        self.assertTrue(10000 < size < 100000)
+        self.assertEqual(estimate_size('x' * 100), 100)
+
+    def test_negative_ttl_should_remember_absent_keys(self):
+        mc = LocalCached(self.backend, negative_ttl=0.1, negative_size=2)
+        self.assertEqual(mc.get('a'), None)
+        self.assertEqual(mc.get_multi(['a', 'b', 'c']), {})
+        self.backend.set('a', 'a')
+        self.backend.set('c', 'c')
+        # 'a' is pushed out by 'b' and 'c'
+        self.assertEqual(mc.get_list(['a', 'b', 'c']), ['a', None, None])
+        self.assertEqual(mc.stats['negative_hits'], 3)
+
+        time.sleep(0.15)
+        self.assertEqual(mc.get('a'), 'a')
+        mc.set('b', 'b')
+        self.assertEqual(mc.get_multi(['a', 'b']), {'a': 'a', 'b': 'b'})
+
+    def test_get_multi_should_not_remember_absent_keys_by_default(self):
+        self.assertEqual(self.mc.get_multi(['a']), {})
+        self.backend.set('a', 'a')
+        self.assertEqual(self.mc.get_multi(['a']), {'a': 'a'})
+        self.assertEqual(self.mc.get('a'), 'a')
+
+class SharedLocalCachedTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+        self.backend = LocalMemcache()
+        self.mc = SharedLocalCached(self.backend, self.path, size=1 << 20,
+                                    slot_size=1024)
+
+    def tearDown(self):
+        self.mc.segment.close()
+        os.unlink(self.path)
+        unittest.TestCase.tearDown(self)
+
+    def test_should_cache_values(self):
+        self.backend.set('a', {'a': 1})
+        self.backend.set('b', 'b')
+        self.assertEqual(self.mc.get('a'), {'a': 1})
+        self.assertEqual(self.mc.get_multi(['a', 'b', 'c']),
+                         {'a': {'a': 1}, 'b': 'b'})
+        self.backend.set('a', 2)
+        self.assertEqual(self.mc.get_list(['a', 'b']), [{'a': 1}, 'b'])
+        self.mc.delete('a')
+        self.assertEqual(self.mc.get('a'), None)
+        self.mc.set('big', 'x' * 2000)
+        self.assertEqual(self.mc.segment.get('big'), None)
+
+    def test_should_take_unicode_keys(self):
+        self.backend.set(u'user:1', 1)
+        self.backend.set(u'\u7528\u6237:1', 2)
+        self.assertEqual(self.mc.get(u'user:1'), 1)
+        self.assertEqual(self.mc.get(u'\u7528\u6237:1'), 2)
+        self.assertEqual(self.mc.segment.get('user:1'), 1)
+        self.assertEqual(self.mc.segment.get(u'\u7528\u6237:1'.encode('utf-8')),
+                         2)
+        self.mc.delete(u'user:1')
+        self.assertEqual(self.mc.segment.get('user:1'), None)
+
+    def test_should_be_shared_between_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            mc = SharedLocalCached(LocalMemcache(), self.path, size=1 << 20,
+                                   slot_size=1024)
+            mc.set('a', range(10))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.mc.get('a'), range(10))
+        self.assertEqual(self.backend.get('a'), None)
+
+    def test_should_evict_when_set_is_full(self):
+        segment = self.mc.segment
+        for i in range(segment.sets * segment.ways * 2):
+            segment.set('key%d' % i, i)
+        self.assertTrue(segment.stats['evictions'] > 0)
+        self.assertEqual(segment.get('key%d' % i), i)
+
+    def test_interrupted_set_should_leave_a_miss(self):
+        segment = self.mc.segment
+        segment.set('a', [1, 2])
+        off = segment._find(segment._set_of('a'), 'a')
+        start = off + shm._SLOT_HEADER.size + 1
+        segment.mm[start:start + 4] = 'junk'
+        self.assertEqual(segment.get('a'), None)
+        self.assertEqual(segment._find(segment._set_of('a'), 'a'), None)
+
+    def test_clear_should_keep_the_segment(self):
+        self.mc.set('a', 1)
+        self.mc.clear()
+        self.assertEqual(self.mc.segment.get('a'), 1)
+        self.mc.wipe()
+        self.assertEqual(self.mc.segment.get('a'), None)
+
+    def test_should_expire_values(self):
+        mc = SharedLocalCached(self.backend, self.path, size=1 << 20,
+                               slot_size=1024, ttl=0.2)
+        self.backend.set('a', 1)
+        self.assertEqual(mc.get('a'), 1)
+        mc.set('b', 2, 0.1)
+        # written from another host
+        self.backend.set('a', 10)
+        self.backend.set('b', 20)
+        time.sleep(0.15)
+        self.assertEqual(mc.get_multi(['a', 'b']), {'a': 1, 'b': 20})
+        time.sleep(0.1)
+        self.assertEqual(mc.get('a'), 10)
+        mc.segment.close()
+        self.assertRaises(ValueError, SharedLocalCached, self.backend,
+                          self.path, size=1 << 20, slot_size=1024, ttl=0)
+
+    def test_close_should_close_the_segment_and_client(self):
+        backend = Mock()
+        mc = SharedLocalCached(backend, self.path, size=1 << 20,
+                               slot_size=1024)
+        mc.close()
+        backend.close.assert_called_once_with()
+        self.assertEqual(mc.segment.fd, None)
+        mc.segment.close()
+
+    def test_should_refuse_other_geometry(self):
+        self.assertRaises(SegmentMismatch, SharedLocalCached, self.backend,
+                          self.path, size=1 << 20, slot_size=2048)
+        self.assertRaises(SegmentMismatch, SharedLocalCached, self.backend,
+                          self.path, size=1 << 20, slot_size=1024, stripes=8)
+
+class ReplicatedVersionTestCase(unittest.TestCase):
+    def test_raw_versions_should_be_replicated(self):
+        master, rep = Mock(), Mock()
+        cache = VersionedLocalCached(Replicated(master, rep), raw=True)
+        cache.set('k', 'v', 100)
+        vkey = rep.set_raw.call_args[0][0]
+        self.assertTrue(vkey.startswith('k:V_'))
+        rep.set_raw.assert_called_once_with(vkey, 'v', 50, 0)
+        master.set_raw.assert_called_once_with(vkey, 'v', 100, 0)
+        rep.set.assert_called_once_with('k:VER2', vkey[4:], 50, True)
+
 class VersionedLocalCachedTestCase(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
@@ -138,6 +969,11 @@ class VersionedLocalCachedTestCase(unittest.TestCase):
         self.mc = mc_from_config(config)
         self.cache = VersionedLocalCached(self.mc)
 
+    def test_fingerprint_should_take_64_bits_without_xxhash(self):
+        with patch('douban.mc.wrapper.xxhash', None):
+            self.assertEqual(len(fingerprint('abc')), 16)
+            self.assertNotEqual(fingerprint('abc'), fingerprint('abd'))
+
     def test_get_should_return_None_when_not_exists_in_mc(self):
         r = self.cache.get('test')
         self.assertEqual(r, None)
@@ -198,6 +1034,20 @@ class VersionedLocalCachedTestCase(unittest.TestCase):
         r = self.cache.get_list(['key1', 'key2'])
         self.assertEqual(r, [1, 2])
 
+    def test_get_multi_should_only_fetch_stale_values(self):
+        self.cache.set('key1', 1)
+        self.cache.set('key2', 2)
+        self.cache.delete('key3')
+        c2 = VersionedLocalCached(self.mc)
+        c2.set('key2', 3)
+        with patch.object(self.mc, 'get_multi', wraps=self.mc.get_multi) as m:
+            r = self.cache.get_multi(['key1', 'key2', 'key3'])
+        self.assertEqual(r, {'key1': 1, 'key2': 3})
+        self.assertEqual(m.call_count, 2)
+        ver = self.mc.get('key2:VER2')
+        m.assert_called_with(['key2:V_' + ver])
+        self.assertEqual(self.cache.dataset['key2'], (3, ver))
+
     def test_delete_should_work(self):
         self.cache.set('key1', 1)
         self.cache.delete('key1')
@@ -212,6 +1062,83 @@ class VersionedLocalCachedTestCase(unittest.TestCase):
         ver2 = self.mc.get('key1:VER2')
         self.assertEqual(ver, ver2)
 
+    def test_raw_set_should_reuse_serialized_value(self):
+        mc = Mock()
+        cache = VersionedLocalCached(mc, raw=True)
+        value = {'a': range(10)}
+        serialized, flag = cmemcached.prepare(value, 1024)
+        with patch('cmemcached.prepare', wraps=cmemcached.prepare) as prepare:
+            cache.set('key', value, 10)
+            prepare.assert_called_once_with(value, 1024)
+        ver = cache.dataset['key'][1]
+        mc.set_raw.assert_called_with('key:V_' + ver, serialized, 10, flag)
+        mc.set.assert_called_once_with('key:VER2', ver, 10)
+
+    def test_raw_should_work_on_debug_clients(self):
+        cache = VersionedLocalCached(LocalMemcache(), raw=True)
+        cache.set('key', {'a': 1})
+        self.assertEqual(VersionedLocalCached(cache.mc).get('key'), {'a': 1})
+        mc = mc_from_config({'servers': [], 'disabled': True},
+                            use_cache=False)
+        self.assertEqual(VersionedLocalCached(mc, raw=True).set('key', 1), 1)
+
+class AsyncCleanTestCase(unittest.TestCase):
+    def writer(self, r):
+        m = Mock(return_value=r)
+        m.__name__ = 'writer'
+        return m
+
+    def test_should_clean_failed_keys_only(self):
+        cleaned = []
+        set_multi = self.writer((False, ['b']))
+        f = async_clean(set_multi, cleaned.append, multi=True)
+        self.assertEqual(f({'a': 1, 'b': 2}, 10), False)
+        set_multi.assert_called_once_with({'a': 1, 'b': 2}, 10,
+                                          return_failure=True)
+        self.assertEqual(f({'a': 1, 'b': 2}, return_failure=True),
+                         (False, ['b']))
+        self.assertEqual(cleaned, ['b', 'b'])
+
+    def test_should_clean_in_bulk_from_background(self):
+        batches = []
+        q = BatchQueue(lambda items: batches.append(sorted(items)),
+                       interval=0.05)
+        delete = async_clean(self.writer(False), None, q)
+        delete_multi = async_clean(self.writer(False), None, q, multi=True)
+        delete('a')
+        delete_multi(['a', 'b', 'c'])
+        q.flush()
+        self.assertEqual(sum(batches, []), ['a', 'b', 'c'])
+
+    def test_should_check_keys_only_when_cleaning(self):
+        cleaned = []
+        delete = async_clean(self.writer(True), cleaned.append)
+        self.assertEqual(delete(1), True)
+        delete = async_clean(self.writer(False), cleaned.append)
+        self.assertRaises(Exception, delete, 1)
+        delete(u'a')
+        delete_multi = async_clean(self.writer(False), cleaned.append,
+                                   multi=True)
+        delete_multi(('b', 'c'))
+        delete_multi(k for k in 'de')
+        self.assertEqual(cleaned, [u'a', 'b', 'c', 'd', 'e'])
+
+    def test_should_clean_inline_when_queue_is_full(self):
+        cleaned = []
+        q = BatchQueue(lambda items: None, maxsize=1)
+        q.pending['x'] = (None, 0)
+        delete = async_clean(self.writer(False), cleaned.append, q)
+        delete('a')
+        self.assertEqual(cleaned, ['a'])
+        self.assertEqual(q.stats['dropped'], 1)
+
+    def test_manager_should_take_bulk_cleaner(self):
+        mc = mc_from_config({'servers': [], 'disabled': True},
+                            use_cache=False, bulk_cleaner=Mock())
+        self.assertTrue(mc.clean_queue is not None)
+        self.assertEqual(mc.delete_multi(['a']), 1)
+        self.assertEqual(mc.clean_queue.stats['queued'], 0)
+
 class AsyncSendTest(unittest.TestCase):
     config = {
             'servers' : ['127.0.0.1:11299'],